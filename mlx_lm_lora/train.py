@@ -19,7 +19,7 @@ from mlx_optimizers import QHAdam
 
 from .trainer.grpo_reward_functions import get_reward_function, get_default_reward_functions, list_available_reward_functions
 from .trainer.online_dpo_trainer import  OnlineDPOTrainingArgs, evaluate_online_dpo, train_online_dpo
-from .trainer.sft_trainer import SFTTrainingArgs, TrainingCallback, evaluate_sft, train_sft
+from .trainer.sft_trainer import SFTTrainingArgs, TrainingCallback, evaluate_sft, sampler_state_path, train_sft
 from .trainer.grpo_trainer import GRPOTrainingArgs, evaluate_grpo, train_grpo
 from .trainer.orpo_trainer import ORPOTrainingArgs, evaluate_orpo, train_orpo
 from .trainer.rflhf_trainer import RLHFTrainingArgs, evaluate_rlhf, train_rlhf
@@ -27,7 +27,7 @@ from .trainer.xpo_trainer import  XPOTrainingArgs, evaluate_xpo, train_xpo
 from .trainer.dpo_trainer import DPOTrainingArgs, evaluate_dpo, train_dpo
 from .trainer.cpo_trainer import CPOTrainingArgs, evaluate_cpo, train_cpo
 from .trainer.datasets import CacheDataset, load_dataset
-from .utils import fuse_and_save_model, from_pretrained
+from .utils import AdapterDisabledModel, fuse_and_save_model, from_pretrained
 
 from mlx_lm.tuner.utils import (
     build_schedule,
@@ -85,6 +85,7 @@ CONFIG_DEFAULTS = {
     "test": False,
     "test_batches": 500,
     "max_seq_length": 2048,
+    "length_buckets": None,
     "config": None,
     "grad_checkpoint": False,
     "lr_schedule": None,
@@ -115,8 +116,24 @@ CONFIG_DEFAULTS = {
     "reward_weights": None,
     "reward_functions": None,
     "reward_functions_file": None,
+    "reward_workers": None,
+    "reward_timeouts": None,
+    "reward_failure_policies": None,
+    "reward_async_concurrency": 32,
+    "reward_cache_path": None,
+    "reward_cache_max_entries": 1_000_000,
     "grpo_loss_type": "grpo",
     "importance_sampling_level": None, # GSPO
+    "rollout_slots": None,
+    "pipeline_rollouts": False,
+    "replay_passes": 1,
+    "replay_max_age": 0,
+    "replay_buffer_mb": None,
+    "probe_group_size": None,
+    "rollout_budget": None,
+    "dynamic_sampling": False,
+    "dynamic_sampling_max_refills": 0,
+    "learner_memory_mb": None,
 }
 
 
@@ -146,6 +163,35 @@ def calculate_iters(train_set, batch_size, epochs) -> int:
     return iters
 
 
+def load_reference_model(args, model: nn.Module):
+    """
+    Load the reference model. Without an explicit reference path, LoRA/DoRA
+    runs reuse the policy with its adapters disabled instead of loading a
+    second copy of the base weights.
+    """
+    if args.reference_model_path:
+        reference_model, _ = load(args.reference_model_path)
+    elif args.train_type in ["lora", "dora"]:
+        reference_model = AdapterDisabledModel(model)
+    else:
+        reference_model, _ = load(args.model)
+    return reference_model
+
+
+def find_sampler_state(args):
+    """
+    The batch sampler state saved next to the adapter weights being resumed
+    from, if there is one.
+    """
+    if args.resume_adapter_file is None:
+        return None
+    state_file = sampler_state_path(args.resume_adapter_file)
+    if not state_file.exists():
+        return None
+    print(f"Resuming the training data order from {state_file}")
+    return str(state_file)
+
+
 def build_parser():
     parser = argparse.ArgumentParser(description="LoRA or QLoRA finetuning.")
     parser.add_argument(
@@ -278,6 +324,13 @@ def build_parser():
         type=int,
         help="Maximum sequence length.",
     )
+    parser.add_argument(
+        "--length-buckets",
+        type=int,
+        nargs="+",
+        help="Sequence lengths that SFT, DPO, ORPO and CPO batches are padded up to, so compiled steps see few shapes.",
+        default=None,
+    )
     parser.add_argument(
         "-c",
         "--config",
@@ -395,6 +448,42 @@ def build_parser():
         ),
         default=None,
     )
+    parser.add_argument(
+        "--reward-workers",
+        type=int,
+        help="Threads that run the reward functions of a batch concurrently. Defaults to one per reward function; 0 runs them one after another.",
+        default=None,
+    )
+    parser.add_argument(
+        "--reward-timeouts",
+        type=str,
+        help="Seconds each reward function may take per batch, in this format [5, 60, none]. Must match the number of reward functions. A function that times out gets NaN rewards.",
+        default=None,
+    )
+    parser.add_argument(
+        "--reward-failure-policies",
+        type=str,
+        help="What to do when each reward function raises, in this format [raise, nan]: 'raise' stops training, 'nan' gives NaN rewards. Must match the number of reward functions.",
+        default=None,
+    )
+    parser.add_argument(
+        "--reward-async-concurrency",
+        type=int,
+        help="Maximum number of async reward function calls awaited at the same time.",
+        default=None,
+    )
+    parser.add_argument(
+        "--reward-cache-path",
+        type=str,
+        help="SQLite file caching rewards by (reward function, prompt, completion, answer) across steps, evaluations and runs.",
+        default=None,
+    )
+    parser.add_argument(
+        "--reward-cache-max-entries",
+        type=int,
+        help="Number of cached rewards kept, evicting the least recently used.",
+        default=None,
+    )
     parser.add_argument(
         "--list-reward-functions",
         action="store_true",
@@ -428,6 +517,75 @@ def build_parser():
             "'token' uses token-level importance sampling, 'sequence' uses sequence-level, and None (default) disables it."
         ),
     )
+    parser.add_argument(
+        "--rollout-slots",
+        type=int,
+        help=(
+            "Number of GRPO completions decoded together. Finished rows are refilled with pending work. "
+            "Defaults to batch_size * group_size."
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--pipeline-rollouts",
+        action="store_true",
+        help=(
+            "Generate the next GRPO rollout before each update and score it on a background thread "
+            "while the update runs, training on rollouts that are one step stale."
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--replay-passes",
+        type=int,
+        help="Optimizer steps per GRPO generation round, each on a rollout drawn from the replay buffer.",
+        default=None,
+    )
+    parser.add_argument(
+        "--replay-max-age",
+        type=int,
+        help="Generation rounds a GRPO rollout stays in the replay buffer. Defaults to 0 (newest rollout only).",
+        default=None,
+    )
+    parser.add_argument(
+        "--replay-buffer-mb",
+        type=float,
+        help="Memory budget of the GRPO replay buffer in MB.",
+        default=None,
+    )
+    parser.add_argument(
+        "--probe-group-size",
+        type=int,
+        help=(
+            "Sample this many GRPO completions per prompt first and grow only the groups whose rewards "
+            "disagree up to group_size. Defaults to a fixed group_size for every prompt."
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--rollout-budget",
+        type=int,
+        help="Maximum GRPO completions per step with adaptive group sizes. Defaults to batch_size * group_size.",
+        default=None,
+    )
+    parser.add_argument(
+        "--dynamic-sampling",
+        action="store_true",
+        help="Drop GRPO groups whose completions all get the same reward before the learner pass.",
+        default=None,
+    )
+    parser.add_argument(
+        "--dynamic-sampling-max-refills",
+        type=int,
+        help="Extra rollouts of fresh prompts used to top a dynamically sampled batch back up to batch_size groups.",
+        default=None,
+    )
+    parser.add_argument(
+        "--learner-memory-mb",
+        type=float,
+        help="Activation memory budget of the GRPO learner pass in MB. Completions are split into micro-batches that fit, with gradients accumulated across them.",
+        default=None,
+    )
     return parser
 
 
@@ -508,6 +666,7 @@ def train_model(
             adapter_file=adapter_file,
             max_seq_length=args.max_seq_length,
             grad_checkpoint=args.grad_checkpoint,
+            length_buckets=args.length_buckets,
             beta=args.beta,
             reward_scaling=args.reward_scaling,
             gradient_accumulation_steps=args.gradient_accumulation_steps,
@@ -532,6 +691,7 @@ def train_model(
             adapter_file=adapter_file,
             max_seq_length=args.max_seq_length,
             grad_checkpoint=args.grad_checkpoint,
+            length_buckets=args.length_buckets,
             beta=args.beta,
             loss_type=args.dpo_cpo_loss_type,
             delta=args.delta,
@@ -540,10 +700,7 @@ def train_model(
         )
 
         print("Loading pretrained reference model")
-        if args.reference_model_path:
-            reference_model, _ = load(args.reference_model_path)
-        else:
-            reference_model, _ = load(args.model)
+        reference_model = load_reference_model(args, model)
 
         train_dpo(
             model=model,
@@ -577,10 +734,7 @@ def train_model(
         )
 
         print("Loading pretrained reference model")
-        if args.reference_model_path:
-            reference_model, _ = load(args.reference_model_path)
-        else:
-            reference_model, _ = load(args.model)
+        reference_model = load_reference_model(args, model)
 
         print("Loading pretrained judge model")
         if args.judge:
@@ -625,10 +779,7 @@ def train_model(
         )
 
         print("Loading pretrained reference model")
-        if args.reference_model_path:
-            reference_model, _ = load(args.reference_model_path)
-        else:
-            reference_model, _ = load(args.model)
+        reference_model = load_reference_model(args, model)
 
         print("Loading pretrained judge model")
         if args.judge:
@@ -676,10 +827,7 @@ def train_model(
         )
 
         print("Loading pretrained reference model")
-        if args.reference_model_path:
-            reference_model, _ = load(args.reference_model_path)
-        else:
-            reference_model, _ = load(args.model)
+        reference_model = load_reference_model(args, model)
 
         print("Loading pretrained judge model")
         if args.judge:
@@ -716,6 +864,7 @@ def train_model(
             adapter_file=adapter_file,
             max_seq_length=args.max_seq_length,
             grad_checkpoint=args.grad_checkpoint,
+            length_buckets=args.length_buckets,
             beta=args.beta,
             loss_type=args.dpo_cpo_loss_type,
             delta=args.delta,
@@ -748,6 +897,7 @@ def train_model(
                 return
             
         grpo_training_args = GRPOTrainingArgs(
+            sampler_state_file=find_sampler_state(args),
             batch_size=args.batch_size,
             iters=args.iters,
             val_batches=args.val_batches,
@@ -770,17 +920,42 @@ def train_model(
                 if args.reward_weights
                 else None
             ),
+            reward_workers=args.reward_workers,
+            reward_async_concurrency=args.reward_async_concurrency,
+            reward_cache_path=args.reward_cache_path,
+            reward_cache_max_entries=args.reward_cache_max_entries,
+            reward_timeouts=(
+                [
+                    None if x.strip().lower() == "none" else float(x)
+                    for x in args.reward_timeouts.strip("[]").split(",")
+                ]
+                if args.reward_timeouts
+                else None
+            ),
+            reward_failure_policies=(
+                [x.strip() for x in args.reward_failure_policies.strip("[]").split(",")]
+                if args.reward_failure_policies
+                else None
+            ),
             importance_sampling_level=args.importance_sampling_level,
             grpo_loss_type=args.grpo_loss_type,
+            rollout_slots=args.rollout_slots,
+            pipeline_rollouts=args.pipeline_rollouts,
+            replay_passes=args.replay_passes,
+            replay_max_age=args.replay_max_age,
+            replay_buffer_mb=args.replay_buffer_mb,
+            probe_group_size=args.probe_group_size,
+            rollout_budget=args.rollout_budget,
+            dynamic_sampling=args.dynamic_sampling,
+            dynamic_sampling_max_refills=args.dynamic_sampling_max_refills,
+            learner_memory_mb=args.learner_memory_mb,
         )
 
         print("Loading pretrained reference model")
-        if args.reference_model_path:
-            reference_model, _ = load(args.reference_model_path)
-        elif args.beta == 0:
+        if args.beta == 0 and not args.reference_model_path:
             reference_model = None
         else:
-            reference_model, _ = load(args.model)
+            reference_model = load_reference_model(args, model)
 
         train_grpo(
             model=model,
@@ -805,7 +980,9 @@ def train_model(
             adapter_file=adapter_file,
             max_seq_length=args.max_seq_length,
             grad_checkpoint=args.grad_checkpoint,
+            length_buckets=args.length_buckets,
             gradient_accumulation_steps=args.gradient_accumulation_steps,
+            sampler_state_file=find_sampler_state(args),
         )
 
         train_sft(
@@ -866,10 +1043,7 @@ def evaluate_model(args, model: nn.Module, tokenizer, test_set):
             print(f"  {metric_name}: {float(metric_value):.3f}")
 
     elif args.train_mode == "rlhf":
-        if args.reference_model_path:
-            reference_model, _ = load(args.reference_model_path)
-        else:
-            reference_model, _ = load(args.model)
+        reference_model = load_reference_model(args, model)
 
         test_loss, _, _, test_metrics = evaluate_rlhf(
             model=model,
@@ -885,10 +1059,7 @@ def evaluate_model(args, model: nn.Module, tokenizer, test_set):
         )
     
     elif args.train_mode == "online_dpo":
-        if args.reference_model_path:
-            reference_model, _ = load(args.reference_model_path)
-        else:
-            reference_model, _ = load(args.model)
+        reference_model = load_reference_model(args, model)
 
         test_loss, _, _, test_metrics = evaluate_online_dpo(
             model=model,
@@ -905,10 +1076,7 @@ def evaluate_model(args, model: nn.Module, tokenizer, test_set):
         )
     
     elif args.train_mode == "xpo":
-        if args.reference_model_path:
-            reference_model, _ = load(args.reference_model_path)
-        else:
-            reference_model, _ = load(args.model)
+        reference_model = load_reference_model(args, model)
 
         test_loss, _, _, test_metrics = evaluate_xpo(
             model=model,
@@ -1,24 +1,34 @@
+from functools import partial
 from pathlib import Path
 from tqdm import tqdm
 import time
 
-from mlx.nn.utils import average_gradients
 from mlx.utils import tree_flatten
 
 from mlx_lm.tuner.callbacks import TrainingCallback
 
-from .sft_trainer import grad_checkpoint
+from .sft_trainer import (
+    GradientAccumulator,
+    bucket_length,
+    grad_checkpoint,
+    score_offset,
+)
 from .dpo_trainer import DPOTrainingArgs as CPOTrainingArgs
+from .logprobs import token_logprobs
 
 import mlx.core as mx
 import mlx.nn as nn
 import numpy as np
 
 
-def get_token_scores(model, x, mask):
-    inputs, targets = x[:, :-1], x[:, 1:]
-    logits = model(inputs).astype(mx.float32)
-    return -nn.losses.cross_entropy(logits, targets) * mask[:, :-1]
+def get_token_scores(model, x, mask, offset: int = 0):
+    """
+    Log-probs of the next tokens of ``x``, masked by ``mask``. Only the
+    positions from ``offset`` on are scored, so the result has
+    ``L - 1 - offset`` columns.
+    """
+    logps, _, _ = token_logprobs(model, x[:, :-1], x[:, offset + 1 :], offset=offset)
+    return logps * mask[:, offset:-1]
 
 def compute_score(scores, mask, loss_type):
     token_count = mask.sum(-1)
@@ -75,7 +85,7 @@ def cpo_loss(
     return mx.mean(losses), reward, num_tokens, metrics
 
 
-def iterate_cpo_batches(dataset, batch_size, max_seq_length, train=False):
+def iterate_cpo_batches(dataset, batch_size, max_seq_length, train=False, length_buckets=None):
     idx = sorted(range(len(dataset)), key=lambda idx: len(dataset[idx]["chosen"]))
 
     step = mx.distributed.init().size()
@@ -101,8 +111,8 @@ def iterate_cpo_batches(dataset, batch_size, max_seq_length, train=False):
                 max(max(chosen_lengths), max(rejected_lengths)), max_seq_length
             )
 
-            # Dynamic padding based on batch content
-            max_length_in_batch = max_length
+            # Pad to a length bucket so the compiled step sees few shapes
+            max_length_in_batch = min(bucket_length(max_length, length_buckets), max_seq_length)
 
             chosen_arr = np.zeros((batch_size // step, max_length_in_batch), np.int32)
             rejected_arr = np.zeros((batch_size // step, max_length_in_batch), np.int32)
@@ -114,6 +124,10 @@ def iterate_cpo_batches(dataset, batch_size, max_seq_length, train=False):
                 (batch_size // step, max_length_in_batch), np.float32
             )
 
+            # Scores line up with their inputs: the first completion token
+            # is scored at the last prompt position
+            mask_starts = [max(x.get("prompt_length", 0) - 1, 0) for x in batch]
+
             for j in range(batch_size // step):
                 chosen_length = min(chosen_lengths[j], max_seq_length)
                 rejected_length = min(rejected_lengths[j], max_seq_length)
@@ -123,12 +137,12 @@ def iterate_cpo_batches(dataset, batch_size, max_seq_length, train=False):
                     :rejected_length
                 ]
 
-                chosen_masks[j, :chosen_length] = 1.0
-                rejected_masks[j, :rejected_length] = 1.0
+                chosen_masks[j, mask_starts[j] : chosen_length] = 1.0
+                rejected_masks[j, mask_starts[j] : rejected_length] = 1.0
 
             yield mx.array(chosen_arr), mx.array(rejected_arr), mx.array(
                 chosen_masks
-            ), mx.array(rejected_masks)
+            ), mx.array(rejected_masks), score_offset(mask_starts, max_length_in_batch)
 
         if not train:
             break
@@ -161,10 +175,10 @@ def evaluate_cpo(
             max_seq_length=max_seq_length,
         ),
     ):
-        chosen, rejected, chosen_masks, rejected_masks = batch
+        chosen, rejected, chosen_masks, rejected_masks, offset = batch
 
-        policy_chosen_scores = get_token_scores(model, chosen, chosen_masks)
-        policy_rejected_scores = get_token_scores(model, rejected, rejected_masks)
+        policy_chosen_scores = get_token_scores(model, chosen, chosen_masks, offset)
+        policy_rejected_scores = get_token_scores(model, rejected, rejected_masks, offset)
 
         policy_chosen_score = compute_score(policy_chosen_scores, chosen_masks, loss_type)
         policy_rejected_score = compute_score(policy_rejected_scores, rejected_masks, loss_type)
@@ -221,28 +235,16 @@ def train_cpo(
     if args.grad_checkpoint:
         grad_checkpoint(model.layers[0])
 
-    state = [model.state, optimizer.state]
-
-    def step(batch):
-        chosen, rejected, chosen_masks, rejected_masks = batch
+    accumulator = GradientAccumulator(model, optimizer, args.gradient_accumulation_steps)
+    state = [model.state, optimizer.state, mx.random.state, accumulator.state]
 
-        policy_chosen_scores = get_token_scores(model, chosen, chosen_masks)
-        policy_rejected_scores = get_token_scores(model, rejected, rejected_masks)
+    def loss_wrapper(model, chosen, rejected, chosen_masks, rejected_masks, offset):
+        policy_chosen_scores = get_token_scores(model, chosen, chosen_masks, offset)
+        policy_rejected_scores = get_token_scores(model, rejected, rejected_masks, offset)
 
         policy_chosen_score = compute_score(policy_chosen_scores, chosen_masks, args.loss_type)
         policy_rejected_score = compute_score(policy_rejected_scores, rejected_masks, args.loss_type)
 
-        (lvalue, reward, toks, metrics), grad = loss_value_and_grad(
-            policy_chosen_score, policy_rejected_score, chosen_masks=chosen_masks, rejected_masks=rejected_masks
-        )
-        
-        if (it + 1) % args.gradient_accumulation_steps == 0:
-            grad = average_gradients(grad)
-            optimizer.update(model, grad)
-
-        return (lvalue / args.gradient_accumulation_steps), reward, toks, metrics
-
-    def loss_wrapper(policy_chosen_score, policy_rejected_score, chosen_masks, rejected_masks):
         return loss_fn(
             policy_chosen_score=policy_chosen_score,
             policy_rejected_score=policy_rejected_score,
@@ -253,6 +255,12 @@ def train_cpo(
             loss_type=args.loss_type,
         )
 
+    @partial(mx.compile, inputs=state, outputs=state)
+    def step(batch, update):
+        (lvalue, reward, toks, metrics), grad = loss_value_and_grad(model, *batch)
+        accumulator.accumulate(grad, update)
+        return lvalue, reward, toks, metrics
+
     loss_value_and_grad = nn.value_and_grad(model, loss_wrapper)
 
     losses = 0
@@ -277,6 +285,7 @@ def train_cpo(
             batch_size=args.batch_size,
             max_seq_length=args.max_seq_length,
             train=True,
+            length_buckets=args.length_buckets,
         ))
 
         if it == 1 or it % args.steps_per_eval == 0 or it == args.iters:
@@ -318,7 +327,7 @@ def train_cpo(
 
             start = time.perf_counter()
 
-        lvalue, reward, toks, metrics = step(batch)
+        lvalue, reward, toks, metrics = step(batch, accumulator.advance())
         losses += lvalue
         rewards += reward
         n_tokens += toks
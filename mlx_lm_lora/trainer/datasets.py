@@ -6,6 +6,35 @@ import json
 from transformers import PreTrainedTokenizer
 
 
+def shared_prefix_length(chosen: List[int], rejected: List[int]) -> int:
+    """
+    Number of leading tokens shared by a chosen and a rejected sequence.
+    """
+    length = 0
+    for a, b in zip(chosen, rejected):
+        if a != b:
+            break
+        length += 1
+    return length
+
+
+def preference_prompt_length(
+    tokenizer: PreTrainedTokenizer,
+    prompt_messages: List[Dict[str, str]],
+    chosen: List[int],
+    rejected: List[int],
+) -> int:
+    """
+    Number of prompt tokens of a chosen/rejected pair: the length of the
+    prompt messages with the generation prompt, so identical openings of the
+    two responses stay scored. It is capped at the prefix the two sequences
+    share, in case the template renders the generation prompt differently
+    from a full conversation.
+    """
+    prompt = tokenizer.apply_chat_template(prompt_messages, add_generation_prompt=True)
+    return min(len(prompt), shared_prefix_length(chosen, rejected))
+
+
 class GRPODataset:
     def __init__(
         self,
@@ -104,9 +133,11 @@ class DPODataset:
         chosen_key: str = "chosen",
         rejected_key: str = "rejected",
         system_key: str = "system",
+        mask_prompt: bool = False,
     ):
         self._chosen_data = []
         self._rejected_data = []
+        self._prompt_lengths = []
 
         for d in data:
             messages = (
@@ -126,9 +157,20 @@ class DPODataset:
 
             self._chosen_data.append(tokenizer.apply_chat_template(chosen_messages, add_generation_prompt=True))
             self._rejected_data.append(tokenizer.apply_chat_template(rejected_messages, add_generation_prompt=True))
+            self._prompt_lengths.append(
+                preference_prompt_length(
+                    tokenizer, base_messages, self._chosen_data[-1], self._rejected_data[-1]
+                )
+                if mask_prompt
+                else 0
+            )
 
     def __getitem__(self, idx: int):
-        return {"chosen": self._chosen_data[idx], "rejected": self._rejected_data[idx]}
+        return {
+            "chosen": self._chosen_data[idx],
+            "rejected": self._rejected_data[idx],
+            "prompt_length": self._prompt_lengths[idx],
+        }
 
     def __len__(self):
         return len(self._chosen_data)
@@ -147,16 +189,20 @@ class ORPODataset:
         rejected_key: str = "rejected",
         preference_score_key: str = "preference_score",
         system_key: str = None,
+        mask_prompt: bool = False,
     ):
         self._chosen_data = []
         self._rejected_data = []
+        self._prompt_lengths = []
         self._scores = []
 
         for d in data:
             prompt_content = d.get(prompt_key, d.get("question", ""))
 
+            prompt_messages = [{"role": "user", "content": prompt_content}]
             if system_key and system_key in d:
                 base_messages = [{"role": "system", "content": d[system_key]}]
+                prompt_messages = base_messages + prompt_messages
                 chosen_messages = base_messages + [
                     {"role": "user", "content": prompt_content}
                 ]
@@ -220,6 +266,11 @@ class ORPODataset:
 
             self._chosen_data.append(chosen_text)
             self._rejected_data.append(rejected_text)
+            self._prompt_lengths.append(
+                preference_prompt_length(tokenizer, prompt_messages, chosen_text, rejected_text)
+                if mask_prompt
+                else 0
+            )
 
             if preference_score_key in d:
                 self._scores.append(float(d[preference_score_key]))
@@ -255,6 +306,7 @@ class ORPODataset:
         return {
             "chosen": self._chosen_data[idx],
             "rejected": self._rejected_data[idx],
+            "prompt_length": self._prompt_lengths[idx],
             "preference_score": self._scores[idx],
         }
 
@@ -441,7 +493,8 @@ def create_dataset(
                 prompt_key=prompt_feature,
                 chosen_key=chosen_feature,
                 rejected_key=rejected_feature,
-                preference_score_key=preference_score_feature
+                preference_score_key=preference_score_feature,
+                mask_prompt=mask_prompt,
             )
         else:
             raise ValueError("Unsupported data format for ORPO training.")
@@ -453,7 +506,8 @@ def create_dataset(
                 prompt_key=prompt_feature,
                 system_key=system_feature,
                 chosen_key=chosen_feature,
-                rejected_key=rejected_feature
+                rejected_key=rejected_feature,
+                mask_prompt=mask_prompt,
                 )
         else:
             raise ValueError("Unsupported data format for DPO training.")
@@ -465,7 +519,8 @@ def create_dataset(
                 prompt_key=prompt_feature,
                 system_key=system_feature,
                 chosen_key=chosen_feature,
-                rejected_key=rejected_feature
+                rejected_key=rejected_feature,
+                mask_prompt=mask_prompt,
                 )
         else:
             raise ValueError("Unsupported data format for Online DPO or CPO training.")
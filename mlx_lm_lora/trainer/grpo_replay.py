@@ -0,0 +1,76 @@
+from collections import deque
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+
+def rollout_nbytes(rollout: Dict[str, Any]) -> int:
+    """
+    Approximate host memory held by a scored rollout: its token ids,
+    sampling log-probs, completion texts and rewards.
+    """
+    num_tokens = sum(len(ids) for ids in rollout["completions"])
+    num_texts = sum(len(text.encode("utf-8")) for text in rollout["completion_texts"])
+    num_rewards = sum(len(rewards) for rewards in rollout["func_rewards"] or [])
+    return 4 * num_tokens + 4 * num_tokens + num_texts + 8 * num_rewards
+
+
+class RolloutReplayBuffer:
+    """
+    Bounded buffer of scored GRPO rollouts that are reused for several
+    optimizer steps.
+
+    Every rollout keeps the token ids, the sampling log-probs and the
+    rewards it was generated with, so replaying it only costs a learner pass
+    and the importance ratio against the sampling log-probs corrects for the
+    policy having moved since. Rollouts are evicted once they are more than
+    ``max_age`` generation rounds old, and the oldest rollouts are evicted
+    while the buffer holds more than ``max_bytes``. The newest rollout is
+    always kept.
+
+    Args:
+        max_age (int): Number of generation rounds a rollout stays in the
+          buffer after the round that produced it.
+        max_bytes (int, optional): Memory budget of the buffer.
+    """
+
+    def __init__(self, max_age: int = 0, max_bytes: Optional[int] = None):
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.round = 0
+        self.nbytes = 0
+        self._entries = deque()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, rollout: Dict[str, Any]):
+        """
+        Start a new generation round with the given rollout.
+        """
+        self.round += 1
+        nbytes = rollout_nbytes(rollout)
+        self._entries.append((self.round, rollout, nbytes))
+        self.nbytes += nbytes
+        self._evict()
+
+    def _evict(self):
+        while len(self._entries) > 1 and (
+            self.round - self._entries[0][0] > self.max_age
+            or (self.max_bytes is not None and self.nbytes > self.max_bytes)
+        ):
+            _, _, nbytes = self._entries.popleft()
+            self.nbytes -= nbytes
+
+    def sample(self) -> Tuple[Dict[str, Any], int]:
+        """
+        Draw a rollout uniformly at random.
+
+        Returns:
+            Tuple[Dict[str, Any], int]: The rollout and its age in generation
+            rounds.
+        """
+        if not self._entries:
+            raise ValueError("Cannot sample from an empty replay buffer.")
+        generation_round, rollout, _ = self._entries[np.random.randint(len(self._entries))]
+        return rollout, self.round - generation_round
@@ -0,0 +1,273 @@
+from typing import Dict, List, Optional
+from pathlib import Path
+import functools
+import hashlib
+import inspect
+import json
+import math
+import re
+import sqlite3
+import threading
+import time
+
+from .grpo_reward_functions import RewardFunctions
+
+
+# Module-level values whose repr is part of a reward function's version
+_CONSTANT_TYPES = (str, bytes, int, float, tuple, frozenset, re.Pattern)
+
+
+def _referenced_globals(code, namespace):
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= _referenced_globals(const, namespace)
+    return {name for name in names if name in namespace}
+
+
+def _source_closure(reward_func) -> List[bytes]:
+    """
+    Sources of a function and of the functions, classes and constants of its
+    own module that it uses, directly or through each other.
+    """
+    module = reward_func.__module__
+    namespace = reward_func.__globals__
+    sources, seen, pending = [], set(), [reward_func]
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        try:
+            sources.append(inspect.getsource(obj).encode("utf-8"))
+        except (OSError, TypeError):
+            code = getattr(obj, "__code__", None)
+            sources.append(code.co_code if code is not None else repr(obj).encode("utf-8"))
+        code = getattr(obj, "__code__", None)
+        if code is None:
+            continue
+        for name in sorted(_referenced_globals(code, namespace)):
+            helper = namespace[name]
+            if isinstance(helper, _CONSTANT_TYPES):
+                sources.append(f"{name} = {helper!r}".encode("utf-8"))
+            elif (
+                (inspect.isfunction(helper) or inspect.isclass(helper))
+                and getattr(helper, "__module__", None) == module
+            ):
+                pending.append(helper)
+    return sources
+
+
+def reward_function_version(reward_func: RewardFunctions) -> str:
+    """
+    The version of a reward function used in cache keys: its
+    ``reward_version`` attribute (see ``register_reward_function``) if set,
+    otherwise a hash of its source code and of the helpers of its own module
+    that it calls, so editing either invalidates its cached rewards. Helpers
+    imported from other modules are not tracked; bump ``version`` when
+    changing those.
+    """
+    version = getattr(reward_func, "reward_version", None)
+    if version is not None:
+        return str(version)
+    digest = hashlib.sha256()
+    for source in _source_closure(reward_func):
+        digest.update(source)
+    return digest.hexdigest()[:16]
+
+
+class RewardCache:
+    """
+    Persistent reward cache in an SQLite file, keyed by a hash of the reward
+    function's name and version and the prompt, completion, answer and type
+    being scored.
+
+    ``wrap`` turns any reward function into one that only computes the
+    rewards it has not seen before, once per distinct completion of a batch.
+    This assumes, as for all built-in reward functions, that a completion's
+    reward does not depend on the other completions of the batch. The
+    least recently used rewards are evicted once the cache holds more than
+    ``max_entries``. Missing rewards (``None`` or NaN, as from failures and
+    timeouts) are not stored, so they are computed again next time. The
+    cache is safe to use from several threads.
+
+    Args:
+        path (str): Path of the SQLite database, created if needed.
+        max_entries (int): Maximum number of cached rewards.
+    """
+
+    def __init__(self, path: str, max_entries: int = 1_000_000):
+        if max_entries < 1:
+            raise ValueError(f"Reward cache size must be at least 1, got {max_entries}.")
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS rewards "
+            "(key TEXT PRIMARY KEY, reward REAL, last_used REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS rewards_last_used ON rewards (last_used)"
+        )
+        self._db.commit()
+        self._size = self._db.execute("SELECT COUNT(*) FROM rewards").fetchone()[0]
+
+    @staticmethod
+    def key(name: str, version: str, prompt, completion, answer, type_info=None) -> str:
+        payload = json.dumps([name, version, prompt, completion, answer, type_info], default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[str, Optional[float]]:
+        """
+        Look up rewards and mark them as recently used.
+        """
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start : start + 500]
+                rows = self._db.execute(
+                    f"SELECT key, reward FROM rewards WHERE key IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+                found.update(rows)
+            if found:
+                now = time.time()
+                self._db.executemany(
+                    "UPDATE rewards SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+                self._db.commit()
+        return found
+
+    def put_many(self, rewards: Dict[str, Optional[float]]):
+        """
+        Store rewards, evicting the least recently used ones over
+        ``max_entries``.
+        """
+        if not rewards:
+            return
+        now = time.time()
+        with self._lock:
+            before = self._db.total_changes
+            self._db.executemany(
+                "INSERT OR IGNORE INTO rewards (key, reward, last_used) VALUES (?, ?, ?)",
+                [(key, reward, now) for key, reward in rewards.items()],
+            )
+            self._size += self._db.total_changes - before
+            excess = self._size - self.max_entries
+            if excess > 0:
+                self._db.execute(
+                    "DELETE FROM rewards WHERE key IN "
+                    "(SELECT key FROM rewards ORDER BY last_used LIMIT ?)",
+                    (excess,),
+                )
+                self._size -= excess
+            self._db.commit()
+
+    def pop_stats(self) -> Dict[str, float]:
+        """
+        Hits and misses since the last call, and the hit rate.
+        """
+        with self._lock:
+            hits, misses = self.hits, self.misses
+            self.hits = self.misses = 0
+        lookups = hits + misses
+        return {
+            "reward_cache_hits": hits,
+            "reward_cache_misses": misses,
+            "reward_cache_hit_rate": hits / lookups if lookups else 0.0,
+        }
+
+    def _plan(self, name, version, prompts, completions, answer, types):
+        keys = [
+            self.key(
+                name,
+                version,
+                prompts[i],
+                completions[i],
+                answer[i],
+                types[i] if types is not None else None,
+            )
+            for i in range(len(completions))
+        ]
+        found = self.get_many(list(set(keys)))
+        # First occurrence of every reward that has to be computed
+        misses = {}
+        for i, key in enumerate(keys):
+            if key not in found and key not in misses:
+                misses[key] = i
+        with self._lock:
+            self.hits += len(keys) - len(misses)
+            self.misses += len(misses)
+        return keys, found, misses
+
+    def _finish(self, keys, found, misses, raw_rewards):
+        computed = dict(zip(misses, raw_rewards or []))
+        self.put_many(
+            {
+                k: float(r)
+                for k, r in computed.items()
+                if r is not None and not math.isnan(float(r))
+            }
+        )
+        return [found[k] if k in found else computed.get(k) for k in keys]
+
+    def wrap(self, reward_func: RewardFunctions) -> RewardFunctions:
+        """
+        A cached version of ``reward_func`` with the same name and calling
+        convention, synchronous or async.
+        """
+        name = reward_func.__name__
+        version = reward_function_version(reward_func)
+
+        def subset(values, indices):
+            return None if values is None else [values[i] for i in indices]
+
+        # The batch context of reward functions that accept one
+        def context_subset(kwargs, indices):
+            if kwargs.get("context") is None:
+                return kwargs
+            return {**kwargs, "context": kwargs["context"].subset(indices)}
+
+        if inspect.iscoroutinefunction(reward_func):
+
+            @functools.wraps(reward_func)
+            async def cached_async(prompts, completions, answer, types=None, **kwargs):
+                keys, found, misses = self._plan(name, version, prompts, completions, answer, types)
+                raw_rewards = []
+                if misses:
+                    indices = list(misses.values())
+                    raw_rewards = await reward_func(
+                        prompts=subset(prompts, indices),
+                        completions=subset(completions, indices),
+                        answer=subset(answer, indices),
+                        types=subset(types, indices),
+                        **context_subset(kwargs, indices),
+                    )
+                return self._finish(keys, found, misses, raw_rewards)
+
+            return cached_async
+
+        @functools.wraps(reward_func)
+        def cached(prompts, completions, answer, types=None, **kwargs):
+            keys, found, misses = self._plan(name, version, prompts, completions, answer, types)
+            raw_rewards = []
+            if misses:
+                indices = list(misses.values())
+                raw_rewards = reward_func(
+                    prompts=subset(prompts, indices),
+                    completions=subset(completions, indices),
+                    answer=subset(answer, indices),
+                    types=subset(types, indices),
+                    **context_subset(kwargs, indices),
+                )
+            return self._finish(keys, found, misses, raw_rewards)
+
+        return cached
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,175 @@
+from typing import Any, Callable, Dict, List, Optional, Sequence
+import inspect
+import re
+import threading
+
+from .grpo_reward_functions import R1CompletionFeatures, r1_batch_features
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+def wants_reward_context(reward_func) -> bool:
+    """
+    Whether a reward function opts in to the batch analysis context by
+    accepting a ``context`` argument.
+    """
+    try:
+        return "context" in inspect.signature(reward_func).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+class RewardContext:
+    """
+    Lazily computed, memoized analysis of the completions of a batch, shared
+    by every reward function that accepts a ``context`` argument.
+
+    Each feature is computed the first time a reward function asks for it
+    and reused by all the others, so expensive work such as tokenizing or
+    splitting the completions happens once per batch instead of once per
+    reward function. Every feature holds one value per completion. Reward
+    functions can memoize their own features with ``feature``.
+
+    Example:
+        @register_reward_function()
+        def concise_reward(prompts, completions, answer, types=None, context=None):
+            return [1.0 if n < 200 else 0.0 for n in context.num_tokens]
+
+    Args:
+        prompts (List[str]): The prompt of each completion.
+        completions (List[str]): The completions.
+        answers (List[str]): The reference answer of each completion.
+        types (List, optional): The type of each completion.
+        completion_ids (List[List[int]], optional): The sampled token ids
+          of each completion. If not given, they are computed with
+          ``tokenizer`` when first needed.
+        tokenizer (optional): Tokenizer used for ``completion_ids``.
+    """
+
+    def __init__(
+        self,
+        prompts: List[str],
+        completions: List[str],
+        answers: List[str],
+        types: Optional[List] = None,
+        completion_ids: Optional[List[List[int]]] = None,
+        tokenizer=None,
+    ):
+        self.prompts = prompts
+        self.completions = completions
+        self.answers = answers
+        self.types = types
+        self.tokenizer = tokenizer
+        self._features: Dict[str, List[Any]] = {}
+        if completion_ids is not None:
+            self._features["completion_ids"] = list(completion_ids)
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_guard = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.completions)
+
+    def feature(self, name: str, compute: Callable[["RewardContext"], List[Any]]) -> List[Any]:
+        """
+        The feature ``name``, computed as ``compute(context)`` the first
+        time it is requested, from any thread, and cached for the batch.
+
+        ``compute`` must return one value per completion.
+        """
+        values = self._features.get(name)
+        if values is not None:
+            return values
+        with self._locks_guard:
+            lock = self._locks.setdefault(name, threading.Lock())
+        with lock:
+            values = self._features.get(name)
+            if values is None:
+                values = list(compute(self))
+                if len(values) != len(self.completions):
+                    raise ValueError(
+                        f"Feature '{name}' has {len(values)} values for "
+                        f"{len(self.completions)} completions."
+                    )
+                self._features[name] = values
+        return values
+
+    def subset(self, indices: Sequence[int]) -> "RewardContext":
+        """
+        The context of a subset of the completions, keeping the features
+        computed so far.
+        """
+        def pick(values):
+            return None if values is None else [values[i] for i in indices]
+
+        context = RewardContext(
+            pick(self.prompts),
+            pick(self.completions),
+            pick(self.answers),
+            pick(self.types),
+            tokenizer=self.tokenizer,
+        )
+        context._features = {name: pick(values) for name, values in list(self._features.items())}
+        return context
+
+    @property
+    def completion_ids(self) -> List[List[int]]:
+        def compute(context):
+            if context.tokenizer is None:
+                raise ValueError("A tokenizer is needed to compute completion token ids.")
+            return [
+                context.tokenizer.encode(c or "", add_special_tokens=False)
+                for c in context.completions
+            ]
+
+        return self.feature("completion_ids", compute)
+
+    @property
+    def num_tokens(self) -> List[int]:
+        return self.feature("num_tokens", lambda c: [len(ids) for ids in c.completion_ids])
+
+    @property
+    def num_chars(self) -> List[int]:
+        return self.feature("num_chars", lambda c: [len(t or "") for t in c.completions])
+
+    @property
+    def words(self) -> List[List[str]]:
+        return self.feature("words", lambda c: [(t or "").split() for t in c.completions])
+
+    @property
+    def num_words(self) -> List[int]:
+        return self.feature("num_words", lambda c: [len(words) for words in c.words])
+
+    @property
+    def sentences(self) -> List[List[str]]:
+        return self.feature(
+            "sentences",
+            lambda c: [
+                [s for s in _SENTENCE_END.split((t or "").strip()) if s]
+                for t in c.completions
+            ],
+        )
+
+    @property
+    def r1_features(self) -> List[R1CompletionFeatures]:
+        return self.feature("r1_features", lambda c: r1_batch_features(c.completions))
+
+    @property
+    def extracted_answers(self) -> List[str]:
+        """
+        The text between the last ``<answer>`` and ``</answer>`` tags.
+        """
+        return self.feature("extracted_answers", lambda c: [f.answer for f in c.r1_features])
+
+    def length_stats(self, feature: str = "num_tokens") -> Dict[str, float]:
+        """
+        Mean, min and max over the batch of a length feature:
+        ``num_tokens``, ``num_chars`` or ``num_words``.
+        """
+        lengths = getattr(self, feature)
+        if not lengths:
+            return {"mean": 0.0, "min": 0.0, "max": 0.0}
+        return {
+            "mean": sum(lengths) / len(lengths),
+            "min": float(min(lengths)),
+            "max": float(max(lengths)),
+        }
@@ -0,0 +1,320 @@
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import inspect
+import threading
+import time
+
+from rich import print
+
+from .grpo_reward_context import RewardContext, wants_reward_context
+from .grpo_reward_functions import RewardFunctions
+
+FAILURE_POLICIES = ("raise", "nan")
+
+# Event loop shared by all async reward functions, and the limit on their
+# concurrent calls
+_loop = None
+_loop_lock = threading.Lock()
+_semaphore = asyncio.Semaphore(32)
+
+
+def reward_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    The event loop that runs async reward functions, started on a daemon
+    thread the first time it is needed.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_loop.run_forever, name="reward-event-loop", daemon=True
+            ).start()
+    return _loop
+
+
+def set_async_reward_concurrency(limit: int):
+    """
+    Set how many async reward calls may be awaited at the same time, across
+    all reward functions.
+    """
+    global _semaphore
+    if limit < 1:
+        raise ValueError(f"Async reward concurrency must be at least 1, got {limit}.")
+    _semaphore = asyncio.Semaphore(limit)
+
+
+async def _score_per_completion(reward_func, kwargs):
+    semaphore = _semaphore
+
+    def one(key, values, i):
+        if values is None:
+            return None
+        return values.subset([i]) if key == "context" else [values[i]]
+
+    async def score_one(i):
+        async with semaphore:
+            rewards = await reward_func(
+                **{k: one(k, v, i) for k, v in kwargs.items()}
+            )
+        return None if rewards is None else rewards[0]
+
+    return await asyncio.gather(
+        *(score_one(i) for i in range(len(kwargs["completions"])))
+    )
+
+
+async def _score_batch(reward_func, kwargs):
+    async with _semaphore:
+        return await reward_func(**kwargs)
+
+
+async def _timed_async_call(reward_func, kwargs):
+    score = (
+        _score_per_completion
+        if getattr(reward_func, "reward_per_completion", False)
+        else _score_batch
+    )
+    start = time.perf_counter()
+    try:
+        raw_rewards, error = await score(reward_func, kwargs), None
+    except Exception as e:
+        raw_rewards, error = None, e
+    return raw_rewards, time.perf_counter() - start, error
+
+
+def _timed_call(reward_func, kwargs):
+    start = time.perf_counter()
+    try:
+        raw_rewards, error = reward_func(**kwargs), None
+    except Exception as e:
+        raw_rewards, error = None, e
+    return raw_rewards, time.perf_counter() - start, error
+
+
+def submit_async_reward(reward_func: RewardFunctions, kwargs) -> Future:
+    """
+    Score a batch with an async reward function on the shared event loop,
+    in one call, or in one call per completion, awaited together, for
+    functions registered with ``per_completion=True``.
+
+    Returns:
+        Future: Resolves to the raw rewards, the latency in seconds and the
+        exception raised, if any.
+    """
+    return asyncio.run_coroutine_threadsafe(
+        _timed_async_call(reward_func, kwargs), reward_event_loop()
+    )
+
+
+def reward_kwargs(reward_func: RewardFunctions, kwargs, context: Optional[RewardContext]):
+    """
+    The arguments of a reward function, with the batch context if it
+    accepts one.
+    """
+    if context is not None and wants_reward_context(reward_func):
+        return {**kwargs, "context": context}
+    return kwargs
+
+
+def to_rewards(raw_rewards, num_completions: int) -> List[float]:
+    """
+    Convert the output of a reward function to floats. Missing rewards (a
+    ``None`` result or ``None`` entries) become NaN.
+    """
+    if raw_rewards is None:
+        return [float("nan")] * num_completions
+    return [float(r) if r is not None else float("nan") for r in raw_rewards]
+
+
+class RewardEngine:
+    """
+    Runs the reward functions of a batch concurrently on a thread pool, so
+    the batch takes as long as the slowest function rather than the sum of
+    all of them. Async reward functions run on the shared event loop
+    instead (see ``submit_async_reward``).
+
+    Every function has its own timeout and failure policy. A function that
+    has not returned within its timeout gets NaN rewards for the batch, the
+    same as a function returning ``None``. Threads cannot be interrupted, so
+    the late call keeps running and the function also gets NaN rewards for
+    the following batches until it returns; late async calls are cancelled
+    instead. Under the ``"nan"`` policy an
+    exception gives NaN rewards as well; under ``"raise"`` it is re-raised.
+
+    ``score`` can be called from several threads at once, such as the
+    pipelined background scorer and a refill or validation batch.
+
+    Args:
+        reward_funcs (List[RewardFunctions]): The reward functions.
+        timeouts (List[Optional[float]], optional): Seconds each function
+          may take, counted from the start of the batch. ``None`` entries
+          wait indefinitely.
+        failure_policies (List[str], optional): ``"raise"`` or ``"nan"`` for
+          each function. Defaults to ``"raise"`` for all of them.
+        max_workers (int, optional): Number of threads. Defaults to one per
+          function. With 0, the functions run one after another on the
+          calling thread and timeouts are not enforced.
+        async_concurrency (int, optional): If given, sets the global limit
+          on concurrent async reward calls (see
+          ``set_async_reward_concurrency``).
+        tokenizer (optional): Tokenizer of the ``RewardContext`` passed to
+          reward functions that accept a ``context`` argument.
+    """
+
+    def __init__(
+        self,
+        reward_funcs: List[RewardFunctions],
+        timeouts: Optional[List[Optional[float]]] = None,
+        failure_policies: Optional[List[str]] = None,
+        max_workers: Optional[int] = None,
+        async_concurrency: Optional[int] = None,
+        tokenizer=None,
+    ):
+        num_funcs = len(reward_funcs)
+        timeouts = [None] * num_funcs if timeouts is None else list(timeouts)
+        failure_policies = (
+            ["raise"] * num_funcs if failure_policies is None else list(failure_policies)
+        )
+        if len(timeouts) != num_funcs:
+            raise ValueError(
+                f"Number of reward timeouts ({len(timeouts)}) must match number of reward "
+                f"functions ({num_funcs})"
+            )
+        if len(failure_policies) != num_funcs:
+            raise ValueError(
+                f"Number of reward failure policies ({len(failure_policies)}) must match number "
+                f"of reward functions ({num_funcs})"
+            )
+        for policy in failure_policies:
+            if policy not in FAILURE_POLICIES:
+                raise ValueError(
+                    f"Unknown reward failure policy '{policy}'. Supported: {', '.join(FAILURE_POLICIES)}."
+                )
+
+        if async_concurrency is not None:
+            set_async_reward_concurrency(async_concurrency)
+
+        self.reward_funcs = reward_funcs
+        self.timeouts = timeouts
+        self.failure_policies = failure_policies
+        self.tokenizer = tokenizer
+        self._wants_context = [wants_reward_context(f) for f in reward_funcs]
+        self._is_async = [inspect.iscoroutinefunction(f) for f in reward_funcs]
+        num_sync = num_funcs - sum(self._is_async)
+        self._sequential = max_workers == 0
+        max_workers = num_sync if max_workers is None else max_workers
+        self._executor = (
+            ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="reward")
+            if max_workers > 0 and num_sync > 0
+            else None
+        )
+        # Calls that outlived their timeout, by function index. Batches can
+        # be scored from several threads at once, so it is guarded by a lock.
+        self._late = {}
+        self._late_lock = threading.Lock()
+
+    def _submit(self, i: int, kwargs) -> Future:
+        if self._is_async[i]:
+            return submit_async_reward(self.reward_funcs[i], kwargs)
+        return self._executor.submit(_timed_call, self.reward_funcs[i], kwargs)
+
+    def _rewards(self, i: int, raw_rewards, error, num_completions: int) -> List[float]:
+        if error is not None:
+            if self.failure_policies[i] == "raise":
+                raise error
+            print(f"[yellow]Reward function {self.reward_funcs[i].__name__} failed: {error!r}[/yellow]")
+        return to_rewards(raw_rewards, num_completions)
+
+    def score(
+        self,
+        prompts: List[str],
+        completions: List[str],
+        answers: List[str],
+        types: Optional[List] = None,
+        completion_ids: Optional[List[List[int]]] = None,
+    ) -> Tuple[List[List[float]], Dict[str, float]]:
+        """
+        Run every reward function over the completions.
+
+        Reward functions that accept a ``context`` argument share one
+        ``RewardContext`` for the batch, built from the completions and
+        their token ids ``completion_ids`` if given.
+
+        Only plain Python values are produced, so this can itself run on a
+        background thread while MLX work continues on the main thread.
+
+        Returns:
+            Tuple[List[List[float]], Dict[str, float]]: One list of rewards
+            per reward function, and the timings: ``<name>_latency`` for
+            every function (its timeout if it timed out) and the wall time
+            of the batch as ``reward_time``.
+        """
+        start = time.perf_counter()
+        kwargs = dict(prompts=prompts, completions=completions, answer=answers, types=types)
+        context = None
+        if any(self._wants_context):
+            context = RewardContext(
+                prompts, completions, answers, types, completion_ids, self.tokenizer
+            )
+        func_rewards = []
+        timings = {}
+
+        if self._sequential:
+            for i, reward_func in enumerate(self.reward_funcs):
+                func_kwargs = reward_kwargs(reward_func, kwargs, context)
+                if self._is_async[i]:
+                    raw_rewards, latency, error = submit_async_reward(reward_func, func_kwargs).result()
+                else:
+                    raw_rewards, latency, error = _timed_call(reward_func, func_kwargs)
+                func_rewards.append(self._rewards(i, raw_rewards, error, len(completions)))
+                timings[f"{reward_func.__name__}_latency"] = latency
+            timings["reward_time"] = time.perf_counter() - start
+            return func_rewards, timings
+
+        futures = []
+        for i, reward_func in enumerate(self.reward_funcs):
+            with self._late_lock:
+                late = [f for f in self._late.pop(i, []) if not f.done()]
+                if late:
+                    self._late[i] = late
+            if late:
+                futures.append(None)
+                continue
+            futures.append(self._submit(i, reward_kwargs(reward_func, kwargs, context)))
+
+        for i, (reward_func, future) in enumerate(zip(self.reward_funcs, futures)):
+            name = reward_func.__name__
+            timeout = self.timeouts[i]
+            if future is not None:
+                remaining = None if timeout is None else max(start + timeout - time.perf_counter(), 0)
+                wait([future], timeout=remaining)
+
+            if future is None or not future.done():
+                if future is None:
+                    print(f"[yellow]Reward function {name} is still running on an earlier batch.[/yellow]")
+                else:
+                    if self._is_async[i]:
+                        future.cancel()
+                    else:
+                        with self._late_lock:
+                            self._late.setdefault(i, []).append(future)
+                    print(f"[yellow]Reward function {name} timed out after {timeout}s.[/yellow]")
+                func_rewards.append(to_rewards(None, len(completions)))
+                timings[f"{name}_latency"] = timeout
+                continue
+
+            raw_rewards, latency, error = future.result()
+            func_rewards.append(self._rewards(i, raw_rewards, error, len(completions)))
+            timings[f"{name}_latency"] = latency
+
+        timings["reward_time"] = time.perf_counter() - start
+        return func_rewards, timings
+
+    def shutdown(self):
+        """
+        Stop the worker threads once their current calls return.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
@@ -1,18 +1,42 @@
-from typing import Callable, List, Optional, Dict
+from dataclasses import dataclass
+from typing import Awaitable, Callable, List, Optional, Dict, Union
 import re
 
-RewardFunctions = Callable[[List[str], List[str], List[str], Optional[List[str]]], List[float]]
+RewardFunctions = Callable[
+    [List[str], List[str], List[str], Optional[List[str]]],
+    Union[List[float], Awaitable[List[float]]],
+]
 
 # Registry to store all reward functions
 REWARD_REGISTRY: Dict[str, RewardFunctions] = {}
 
-def register_reward_function(name: str = None):
+def register_reward_function(name: str = None, version: str = None, per_completion: bool = False):
     """
     Decorator to register a reward function in the global registry.
-    
+
+    Reward functions may also be ``async def``. Those run on a shared event
+    loop, with at most ``reward_async_concurrency`` calls awaited at a time
+    across all async reward functions. They are called once per batch,
+    like synchronous ones, unless registered with ``per_completion=True``:
+    then they are called once per completion, with single-element lists,
+    all calls of a batch are awaited together, and they should return a
+    list with one reward.
+
+    Reward functions that accept a ``context`` argument also get the
+    ``RewardContext`` of the batch, which computes features such as token
+    ids, word and sentence splits and extracted answers once for all reward
+    functions.
+
     Args:
         name: Optional custom name for the reward function.
               If None, the function's name will be used.
+        version: Optional version used in reward cache keys. Bump it to
+              invalidate cached rewards. If None, a hash of the function's
+              source and of the helpers it uses from its own module is
+              used. Set it when the reward depends on anything else, such
+              as helpers imported from other modules or a remote scorer.
+        per_completion: Call an async reward function once per completion
+              instead of once per batch.
     
     Returns:
         Decorator function
@@ -22,9 +46,18 @@ def register_reward_function(name: str = None):
         def my_custom_reward(prompts, completions, answers, types=None):
             # Your reward logic here
             return [1.0 if condition else 0.0 for _ in completions]
+
+        @register_reward_function(per_completion=True)
+        async def my_judge_reward(prompts, completions, answer, types=None):
+            score = await client.score(prompts[0], completions[0])
+            return [score]
     """
     def decorator(func: RewardFunctions):
         func_name = name or func.__name__
+        if version is not None:
+            func.reward_version = version
+        if per_completion:
+            func.reward_per_completion = True
         REWARD_REGISTRY[func_name] = func
         return func
     return decorator
@@ -64,15 +97,138 @@ def list_available_reward_functions() -> List[str]:
     """
     return list(REWARD_REGISTRY.keys())
 
+# Every tag the R1 rewards look at, matched in a single pass. Tags cannot
+# overlap, so the matches are exactly what str.find/str.count would see.
+_R1_TAG_PATTERN = re.compile(r"<think>\n?|</think>|<answer>|</answer>")
+_R1_STRICT_FORMAT_PATTERN = re.compile(r"<think> .*? </think><answer> .*? </answer>")
+
+# Features of recently scored completions, shared by the R1 rewards
+_R1_FEATURE_CACHE: Dict[str, "R1CompletionFeatures"] = {}
+_R1_FEATURE_CACHE_SIZE = 4096
+
+
+@dataclass(frozen=True)
+class R1CompletionFeatures:
+    """
+    Everything the R1 rewards need from one completion, from a single scan.
+
+    Attributes:
+        think_start, think_end, answer_start, answer_end: Position of the
+          first ``<think>``, ``</think>``, ``<answer>`` and ``</answer>``,
+          or -1.
+        think_newline_count, think_end_count, answer_start_count,
+          answer_end_count: Number of ``<think>\\n``, ``</think>``,
+          ``<answer>`` and ``</answer>`` tags.
+        answer: Stripped text between the last ``<answer>`` and the
+          ``</answer>`` after it.
+        trailing_text: Text after the last ``</answer>``, or the whole
+          completion if there is none.
+        soft_format: Whether the first tags are in order around non-empty
+          reasoning and answer.
+        strict_format: Whether the completion matches the strict R1 format.
+    """
+
+    think_start: int = -1
+    think_end: int = -1
+    answer_start: int = -1
+    answer_end: int = -1
+    think_newline_count: int = 0
+    think_end_count: int = 0
+    answer_start_count: int = 0
+    answer_end_count: int = 0
+    answer: str = ""
+    trailing_text: str = ""
+    soft_format: bool = False
+    strict_format: bool = False
+
+
+def r1_completion_features(text: str) -> R1CompletionFeatures:
+    """
+    Scan a completion once for the tags used by the R1 rewards.
+    """
+    if not text:
+        return R1CompletionFeatures()
+
+    first = {}
+    counts = {"<think>\n": 0, "</think>": 0, "<answer>": 0, "</answer>": 0}
+    last_answer_start = -1
+    # First </answer> after the last <answer>, and the last </answer>
+    answer_close = -1
+    last_answer_end = -1
+    for match in _R1_TAG_PATTERN.finditer(text):
+        tag, pos = match.group(), match.start()
+        if tag.startswith("<think>"):
+            if tag == "<think>\n":
+                counts[tag] += 1
+            tag = "<think>"
+        else:
+            counts[tag] += 1
+        first.setdefault(tag, pos)
+        if tag == "<answer>":
+            last_answer_start, answer_close = pos, -1
+        elif tag == "</answer>":
+            if answer_close == -1:
+                answer_close = pos
+            last_answer_end = pos
+
+    answer_from = last_answer_start + len("<answer>") if last_answer_start != -1 else 0
+    answer = text[answer_from : answer_close if answer_close != -1 else len(text)].strip()
+    trailing_text = (
+        text[last_answer_end + len("</answer>") :] if last_answer_end != -1 else text
+    )
+
+    think_start = first.get("<think>", -1)
+    think_end = first.get("</think>", -1)
+    answer_start = first.get("<answer>", -1)
+    answer_end = first.get("</answer>", -1)
+    soft_format = (
+        -1 < think_start < think_end < answer_start < answer_end
+        and bool(text[think_start + 13 : think_end].strip())
+        and bool(text[answer_start + 8 : answer_end].strip())
+    )
+    strict_format = (
+        think_end != -1
+        and answer_end != -1
+        and _R1_STRICT_FORMAT_PATTERN.search(text) is not None
+    )
+
+    return R1CompletionFeatures(
+        think_start=think_start,
+        think_end=think_end,
+        answer_start=answer_start,
+        answer_end=answer_end,
+        think_newline_count=counts["<think>\n"],
+        think_end_count=counts["</think>"],
+        answer_start_count=counts["<answer>"],
+        answer_end_count=counts["</answer>"],
+        answer=answer,
+        trailing_text=trailing_text,
+        soft_format=soft_format,
+        strict_format=strict_format,
+    )
+
+
+def r1_batch_features(completions: List[str]) -> List[R1CompletionFeatures]:
+    """
+    Features of a batch of completions. The R1 rewards score the same
+    completions in turn, so features are kept for the completions of the
+    last few batches and each completion is scanned only once per step.
+    """
+    if len(_R1_FEATURE_CACHE) + len(completions) > _R1_FEATURE_CACHE_SIZE:
+        _R1_FEATURE_CACHE.clear()
+    features = []
+    for completion in completions:
+        feature = _R1_FEATURE_CACHE.get(completion)
+        if feature is None:
+            feature = r1_completion_features(completion)
+            if completion:
+                _R1_FEATURE_CACHE[completion] = feature
+        features.append(feature)
+    return features
+
 
 def r1_extract_xml_answer(text: str) -> str:
-    try:
-        answer = text.split("<answer>")[-1]
-        answer = answer.split("</answer>")[0]
-        return answer.strip()
-    except:
-        print("r1_extract_xml_answer returned empty string")
-        return ""
+    return r1_completion_features(text).answer
 
 @register_reward_function()
 def r1_int_reward_func(
@@ -80,8 +236,10 @@ def r1_int_reward_func(
 ) -> list[float]:
     if not completions:
         return [0.0] * len(prompts)
-    extracted_responses = [r1_extract_xml_answer(r) for r in completions]
-    return [0.5 if r and r.isdigit() else 0.0 for r in extracted_responses]
+    return [
+        0.5 if f.answer and f.answer.isdigit() else 0.0
+        for f in r1_batch_features(completions)
+    ]
 
 @register_reward_function()
 def r1_accuracy_reward_func(
@@ -89,9 +247,9 @@ def r1_accuracy_reward_func(
 ) -> list[float]:
     if not completions or not answer:
         return [0.0] * len(prompts)
-    extracted_responses = [r1_extract_xml_answer(r) for r in completions]
     return [
-        2.0 if r and a and r == a else 0.0 for r, a in zip(extracted_responses, answer)
+        2.0 if f.answer and a and f.answer == a else 0.0
+        for f, a in zip(r1_batch_features(completions), answer)
     ]
 
 @register_reward_function()
@@ -100,32 +258,7 @@ def r1_soft_format_reward_func(
 ) -> list[float]:
     if not completions:
         return [0.0] * len(prompts)
-
-    scores = []
-    for completion in completions:
-        if not completion:
-            scores.append(0.0)
-            continue
-
-        reason_start = completion.find("<think>")
-        reason_end = completion.find("</think>")
-        answer_start = completion.find("<answer>")
-        answer_end = completion.find("</answer>")
-
-        if (
-            reason_start != -1
-            and reason_end != -1
-            and answer_start != -1
-            and answer_end != -1
-            and reason_start < reason_end < answer_start < answer_end
-        ):
-            reason_content = completion[reason_start + 13 : reason_end].strip()
-            answer_content = completion[answer_start + 8 : answer_end].strip()
-            if reason_content and answer_content:
-                scores.append(0.5)
-                continue
-        scores.append(0.0)
-    return scores
+    return [0.5 if f.soft_format else 0.0 for f in r1_batch_features(completions)]
 
 @register_reward_function()
 def r1_strict_format_reward_func(
@@ -133,9 +266,7 @@ def r1_strict_format_reward_func(
 ) -> list[float]:
     if not completions:
         return [0.0] * len(prompts)
-    pattern = r"<think> .*? </think><answer> .*? </answer>"
-    matches = [bool(re.search(pattern, r)) if r else False for r in completions]
-    return [0.5 if match else 0.0 for match in matches]
+    return [0.5 if f.strict_format else 0.0 for f in r1_batch_features(completions)]
 
 @register_reward_function()
 def r1_count_xml(
@@ -144,20 +275,16 @@ def r1_count_xml(
     if not completions:
         return [0.0] * len(prompts)
     scores = []
-    for text in completions:
-        if not text:
-            scores.append(0.0)
-            continue
+    for f in r1_batch_features(completions):
         count = 0.0
-        if text.count("<think>\n") == 1:
+        if f.think_newline_count == 1:
             count += 0.125
-        if text.count("</think>") == 1:
+        if f.think_end_count == 1:
             count += 0.125
-        if text.count("<answer>") == 1:
+        if f.answer_start_count == 1:
             count += 0.125
-        if text.count("</answer>") == 1:
+        if f.answer_end_count == 1:
             count += 0.125
-        end_text = text.split("</answer>")[-1]
-        count -= len(end_text) * 0.001 if len(end_text) > 0 else 0
+        count -= len(f.trailing_text) * 0.001
         scores.append(max(0.0, count))
     return scores
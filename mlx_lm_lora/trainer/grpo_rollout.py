@@ -0,0 +1,347 @@
+from collections import deque
+from typing import Callable, Dict, List, Optional, Tuple
+
+import mlx.core as mx
+import mlx.nn as nn
+import numpy as np
+
+
+def make_padded_mask(left_padding: mx.array, N: int, offset: int = 0):
+    """
+    Boolean attention mask of shape ``(B, 1, N, offset + N)`` for ``N``
+    queries that follow ``offset`` cached positions of left-padded rows.
+    Padded query positions attend to themselves only so they stay finite.
+    """
+    rinds = mx.arange(offset + N)
+    linds = mx.arange(offset, offset + N)
+    causal = linds[:, None] >= rinds[None]
+    not_padding = rinds[None] >= left_padding[:, None]
+    mask = causal[None] & not_padding[:, None]
+    mask = mask | (linds[:, None] == rinds[None])[None]
+    return mask[:, None]
+
+
+class BatchedKVCache:
+    """
+    KV cache for a batch of left-padded rows that are decoded together.
+
+    All rows share one position (``offset``), which is what the attention
+    layers use for RoPE. Shorter prompts are left-padded and ``left_padding``
+    records how many leading stored positions of each row are masked out of
+    attention. The stored keys start at position ``start``, so leading
+    columns that every row masks can be dropped without moving the rows.
+    """
+
+    def __init__(self, left_padding: List[int], offset: int = 0):
+        self.keys = None
+        self.values = None
+        self.offset = offset
+        self.start = offset
+        self.step = 256
+        self.left_padding = mx.array(left_padding)
+
+    @property
+    def size(self):
+        return self.offset - self.start
+
+    def update_and_fetch(self, keys, values):
+        prev = self.size
+        if self.keys is None or (prev + keys.shape[2]) > self.keys.shape[2]:
+            B, n_kv_heads, _, k_head_dim = keys.shape
+            v_head_dim = values.shape[3]
+            n_steps = (self.step + keys.shape[2] - 1) // self.step
+            k_shape = (B, n_kv_heads, n_steps * self.step, k_head_dim)
+            v_shape = (B, n_kv_heads, n_steps * self.step, v_head_dim)
+            new_k = mx.zeros(k_shape, keys.dtype)
+            new_v = mx.zeros(v_shape, values.dtype)
+            if self.keys is not None:
+                if prev % self.step != 0:
+                    self.keys = self.keys[..., :prev, :]
+                    self.values = self.values[..., :prev, :]
+                self.keys = mx.concatenate([self.keys, new_k], axis=2)
+                self.values = mx.concatenate([self.values, new_v], axis=2)
+            else:
+                self.keys, self.values = new_k, new_v
+
+        self.offset += keys.shape[2]
+        self.keys[..., prev : self.size, :] = keys
+        self.values[..., prev : self.size, :] = values
+        return self.keys[..., : self.size, :], self.values[..., : self.size, :]
+
+    @property
+    def state(self):
+        return self.keys[..., : self.size, :], self.values[..., : self.size, :]
+
+    def make_mask(self, N: int):
+        """
+        Attention mask for the next ``N`` positions. Padded query positions
+        attend to themselves only, so they never leak NaNs into the cached
+        values.
+        """
+        return make_padded_mask(self.left_padding, N, self.size)
+
+    def select(self, rows: mx.array):
+        """
+        Keep (and possibly repeat) the given rows, in the given order. Used to
+        fork one prefilled prompt into several decode rows and to drop
+        retired rows.
+        """
+        self.keys = self.keys[rows, :, : self.size, :]
+        self.values = self.values[rows, :, : self.size, :]
+        self.left_padding = self.left_padding[rows]
+
+    def trim(self, n: int):
+        """
+        Drop ``n`` leading stored positions, which every row must mask.
+        """
+        if n > 0:
+            self.keys = self.keys[..., n : self.size, :]
+            self.values = self.values[..., n : self.size, :]
+            self.start += n
+            self.left_padding = self.left_padding - n
+
+    def pad(self, n: int):
+        """
+        Prepend ``n`` masked positions to the stored keys and values.
+        """
+        if n > 0:
+            B, n_kv_heads, _, k_head_dim = self.keys.shape
+            pad_k = mx.zeros((B, n_kv_heads, n, k_head_dim), self.keys.dtype)
+            pad_v = mx.zeros((B, n_kv_heads, n, self.values.shape[3]), self.values.dtype)
+            self.keys = mx.concatenate([pad_k, self.keys[..., : self.size, :]], axis=2)
+            self.values = mx.concatenate([pad_v, self.values[..., : self.size, :]], axis=2)
+            self.start -= n
+            self.left_padding = self.left_padding + n
+
+    def extend(self, other: "BatchedKVCache"):
+        """
+        Append the rows of ``other``, which must be at the same position.
+        """
+        if other.offset != self.offset:
+            raise ValueError(
+                f"Cannot merge caches at positions {other.offset} and {self.offset}."
+            )
+        other.pad(other.start - self.start)
+        self.pad(self.start - other.start)
+        self.keys = mx.concatenate([self.keys[..., : self.size, :], other.keys], axis=0)
+        self.values = mx.concatenate([self.values[..., : self.size, :], other.values], axis=0)
+        self.left_padding = mx.concatenate([self.left_padding, other.left_padding])
+
+
+def make_batched_cache(
+    model: nn.Module, left_padding: List[int], offset: int = 0
+) -> List[BatchedKVCache]:
+    return [BatchedKVCache(left_padding, offset) for _ in range(len(model.layers))]
+
+
+def _model_step(model, tokens, prompt_cache):
+    mask = prompt_cache[0].make_mask(tokens.shape[1])
+    logits = model(tokens, mask=mask, cache=prompt_cache)
+    return logits[:, -1, :]
+
+
+def _sample(sampler, logits):
+    """
+    Sample the next token of every row and return it with its log-probability.
+    """
+    logprobs = logits.astype(mx.float32)
+    logprobs = logprobs - mx.logsumexp(logprobs, axis=-1, keepdims=True)
+    y = sampler(logprobs)
+    return y, mx.take_along_axis(logprobs, y[:, None], axis=-1).squeeze(-1)
+
+
+def _prefill(
+    model: nn.Module,
+    prompts: List[List[int]],
+    offset: int,
+    prefill_step_size: int,
+) -> Tuple[List[BatchedKVCache], mx.array]:
+    """
+    Prefill left-padded prompts so that the last prompt token of every row
+    sits at position ``offset - 1``, and return the cache together with the
+    next-token logits.
+    """
+    lengths = [len(p) for p in prompts]
+    max_prompt_len = max(lengths)
+    left_padding = [max_prompt_len - n for n in lengths]
+
+    prompt_arr = np.zeros((len(prompts), max_prompt_len), np.int32)
+    for i, p in enumerate(prompts):
+        prompt_arr[i, left_padding[i] :] = p
+    y = mx.array(prompt_arr)
+
+    prompt_cache = make_batched_cache(model, left_padding, offset - max_prompt_len)
+
+    while y.shape[1] > prefill_step_size:
+        _model_step(model, y[:, :prefill_step_size], prompt_cache)
+        mx.eval([c.state for c in prompt_cache])
+        y = y[:, prefill_step_size:]
+        mx.clear_cache()
+
+    return prompt_cache, _model_step(model, y, prompt_cache)
+
+
+def batch_generate(
+    model: nn.Module,
+    prompts: List[List[int]],
+    max_tokens: int,
+    sampler: Callable[[mx.array], mx.array],
+    stop_token_ids: List[int],
+    group_size: int = 1,
+    num_slots: Optional[int] = None,
+    prefill_step_size: int = 2048,
+    stop_sequences: Optional[List[List[int]]] = None,
+) -> Tuple[List[List[int]], List[List[float]], Dict[str, float]]:
+    """
+    Sample ``group_size`` completions per prompt with a continuously batched
+    decode loop.
+
+    Every (prompt, group member) pair is a work item. Up to ``num_slots``
+    items are decoded together, one sampled token per row per step. A row is
+    retired as soon as it samples a stop token, completes a stop sequence or
+    reaches ``max_tokens``, and its slot is refilled with the next pending
+    work item, so the decode batch stays full until the queue drains. Once the queue is empty,
+    retired rows are dropped from the batch instead of being decoded on.
+
+    Work items that are admitted together are prefilled once per unique
+    prompt, and the prefilled cache is forked into one decode row per group
+    member, so prefill cost does not grow with the group size.
+
+    Args:
+        model (nn.Module): The language model.
+        prompts (List[List[int]]): Unique prompt token ids.
+        max_tokens (int): Maximum number of tokens to sample per row.
+        sampler (Callable[mx.array, mx.array]): Maps a ``(B, V)`` matrix of
+          log-probabilities to ``(B,)`` sampled token ids.
+        stop_token_ids (List[int]): Tokens that end a row. They are not part
+          of the returned completion.
+        group_size (int): Number of completions to sample per prompt.
+        num_slots (int, optional): Maximum number of rows decoded together.
+          Default: all work items at once.
+        prefill_step_size (int): Number of prompt positions per prefill chunk.
+        stop_sequences (List[List[int]], optional): Token sequences that end a
+          row once its completion ends with one of them. They are kept in the
+          returned completion.
+
+    Returns:
+        Tuple[List[List[int]], List[List[float]], Dict[str, float]]: The
+        sampled completion ids, ``group_size`` consecutive rows per prompt,
+        the log-probability of every sampled token under the model (before
+        any temperature or other sampler transforms), and rollout statistics.
+        ``rollout_slot_occupancy`` is the fraction of slot-steps that decoded
+        a live row; a static batch that keeps decoding finished rows until
+        the longest one ends corresponds to ``useful tokens / (rows * steps)``.
+    """
+    queue = deque(p for p in range(len(prompts)) for _ in range(group_size))
+    num_items = len(queue)
+    num_slots = min(num_slots or num_items, num_items)
+    stop_set = set(stop_token_ids)
+
+    # Stop sequences keyed by their last token, so each step only checks the
+    # suffixes that the newly sampled token can complete
+    stop_suffixes = {}
+    for seq in stop_sequences or []:
+        if seq:
+            stop_suffixes.setdefault(seq[-1], []).append(list(seq))
+
+    outputs = [[] for _ in range(num_items)]
+    output_logprobs = [[] for _ in range(num_items)]
+    if max_tokens <= 0 or num_items == 0:
+        return outputs, output_logprobs, {"rollout_slot_occupancy": 0.0}
+
+    # Rows start at or after the longest prompt, so any refill fits behind them
+    offset = max(len(p) for p in prompts)
+
+    active_items = []
+    active_tokens = []
+    active_logprobs = []
+    prompt_cache = None
+    y = None
+    next_item = 0
+    decode_steps = 0
+    live_row_steps = 0
+
+    def _admit(n):
+        nonlocal prompt_cache, y, next_item
+        admitted = [queue.popleft() for _ in range(n)]
+        unique = sorted(set(admitted))
+        rows = mx.array([unique.index(p) for p in admitted])
+
+        new_cache, logits = _prefill(
+            model, [prompts[p] for p in unique], offset, prefill_step_size
+        )
+        for c in new_cache:
+            c.select(rows)
+        new_y, new_logprobs = _sample(sampler, logits[rows])
+        mx.eval(new_y, new_logprobs)
+
+        if prompt_cache is None:
+            prompt_cache, y = new_cache, new_y
+        else:
+            for c, new_c in zip(prompt_cache, new_cache):
+                c.extend(new_c)
+            y = mx.concatenate([y, new_y])
+
+        for token, logprob in zip(new_y.tolist(), new_logprobs.tolist()):
+            active_items.append(next_item)
+            active_tokens.append([token])
+            active_logprobs.append([logprob])
+            next_item += 1
+
+    def _retire():
+        nonlocal prompt_cache, y
+        keep = []
+        for i, tokens in enumerate(active_tokens):
+            if tokens[-1] in stop_set:
+                outputs[active_items[i]] = tokens[:-1]
+                output_logprobs[active_items[i]] = active_logprobs[i][:-1]
+            elif len(tokens) >= max_tokens or any(
+                tokens[-len(seq) :] == seq for seq in stop_suffixes.get(tokens[-1], ())
+            ):
+                outputs[active_items[i]] = tokens
+                output_logprobs[active_items[i]] = active_logprobs[i]
+            else:
+                keep.append(i)
+        if len(keep) == len(active_items):
+            return
+
+        active_items[:] = [active_items[i] for i in keep]
+        active_tokens[:] = [active_tokens[i] for i in keep]
+        active_logprobs[:] = [active_logprobs[i] for i in keep]
+        if not keep:
+            prompt_cache, y = None, None
+            return
+
+        rows = mx.array(keep)
+        for c in prompt_cache:
+            c.select(rows)
+        n = min(prompt_cache[0].left_padding.min().item(), prompt_cache[0].size)
+        for c in prompt_cache:
+            c.trim(n)
+        y = y[rows]
+
+    _admit(num_slots)
+    while True:
+        _retire()
+        while queue and len(active_items) < num_slots:
+            _admit(min(num_slots - len(active_items), len(queue)))
+            _retire()
+        if not active_items:
+            break
+
+        logits = _model_step(model, y[:, None], prompt_cache)
+        y, logprobs = _sample(sampler, logits)
+        mx.eval(y, logprobs)
+        offset += 1
+        decode_steps += 1
+        live_row_steps += len(active_items)
+        for tokens, token_logprobs, token, logprob in zip(
+            active_tokens, active_logprobs, y.tolist(), logprobs.tolist()
+        ):
+            tokens.append(token)
+            token_logprobs.append(logprob)
+
+    stats = {
+        "rollout_slot_occupancy": live_row_steps / max(decode_steps * num_slots, 1),
+    }
+    return outputs, output_logprobs, stats
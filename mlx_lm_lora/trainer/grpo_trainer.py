@@ -1,5 +1,6 @@
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass, field
-from typing import List, Optional
+from typing import Dict, List, Optional
 from pathlib import Path
 from tqdm import tqdm
 import time
@@ -14,10 +15,20 @@ import wandb
 
 from mlx_lm.tuner.callbacks import TrainingCallback
 
-from .sft_trainer import SFTTrainingArgs, average_gradients, grad_checkpoint
+from .sft_trainer import (
+    BatchSampler,
+    GradientAccumulator,
+    SFTTrainingArgs,
+    grad_checkpoint,
+    save_sampler_state,
+)
 
-from mlx_lm.models import cache
-from mlx_lm.generate import generate, make_sampler
+from mlx_lm.generate import make_sampler
+from .grpo_replay import RolloutReplayBuffer
+from .grpo_reward_cache import RewardCache
+from .grpo_reward_engine import RewardEngine
+from .grpo_rollout import batch_generate, make_padded_mask
+from .logprobs import CHUNK_TOKENS, token_logprobs
 from .grpo_reward_functions import (
     RewardFunctions,
     r1_accuracy_reward_func,
@@ -79,24 +90,335 @@ class GRPOTrainingArgs(SFTTrainingArgs):
                 "stable training and better alignment with  sequence-level rewards.."
         },
     )
+    rollout_slots: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Number of completions decoded together during rollouts. Finished rows are refilled "
+                "with pending (prompt, group member) work until the queue drains. If `None`, uses "
+                "batch_size * group_size."
+        },
+    )
+    pipeline_rollouts: bool = field(
+        default=False,
+        metadata={
+            "help": "Generate the next rollout before each gradient step and score it on a background thread "
+                "while the step runs. Rollouts are one update stale, which the importance ratio against "
+                "the sampling log-probs corrects for."
+        },
+    )
+    replay_passes: int = field(
+        default=1,
+        metadata={
+            "help": "Number of optimizer steps per generation round (PPO-style mu). Each step trains on a "
+                "rollout drawn from the replay buffer."
+        },
+    )
+    replay_max_age: int = field(
+        default=0,
+        metadata={
+            "help": "Number of generation rounds a rollout stays in the replay buffer after the round that "
+                "produced it. With 0 only the newest rollout is replayed."
+        },
+    )
+    replay_buffer_mb: Optional[float] = field(
+        default=None,
+        metadata={
+            "help": "Memory budget of the replay buffer in MB. The oldest rollouts are evicted first. If "
+                "`None`, only age limits the buffer."
+        },
+    )
+    probe_group_size: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Adaptive group sizes: sample this many completions per prompt first, and grow only the "
+                "groups whose probe rewards disagree up to group_size. If `None`, every prompt gets "
+                "group_size completions."
+        },
+    )
+    rollout_budget: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "With adaptive group sizes, maximum number of completions sampled per step. If `None`, "
+                "uses batch_size * group_size."
+        },
+    )
+    dynamic_sampling: bool = field(
+        default=False,
+        metadata={
+            "help": "Drop groups whose completions all get the same total reward before the learner pass, "
+                "since their advantages are all zero."
+        },
+    )
+    dynamic_sampling_max_refills: int = field(
+        default=0,
+        metadata={
+            "help": "With dynamic sampling, number of extra rollouts of fresh prompts used to top the batch "
+                "back up to batch_size groups."
+        },
+    )
+    reward_workers: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Threads that run the reward functions of a batch concurrently. If `None`, uses one per "
+                "reward function. With 0, the reward functions run one after another and timeouts are "
+                "not enforced."
+        },
+    )
+    reward_timeouts: Optional[List[Optional[float]]] = field(
+        default=None,
+        metadata={
+            "help": "Seconds each reward function may take per batch. Must match the number of reward "
+                "functions. A function that times out gets NaN rewards for the batch. If `None`, there "
+                "are no timeouts."
+        },
+    )
+    reward_failure_policies: Optional[List[str]] = field(
+        default=None,
+        metadata={
+            "help": "What to do when each reward function raises: 'raise' stops training, 'nan' gives "
+                "NaN rewards for the batch. Must match the number of reward functions. If `None`, all "
+                "functions use 'raise'."
+        },
+    )
+    reward_async_concurrency: int = field(
+        default=32,
+        metadata={
+            "help": "Maximum number of async reward function calls awaited at the same time, across all "
+                "async reward functions."
+        },
+    )
+    reward_cache_path: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Path of an SQLite file caching the rewards of every (reward function, prompt, "
+                "completion, answer), reused across steps, evaluations and runs. If `None`, rewards are "
+                "not cached."
+        },
+    )
+    reward_cache_max_entries: int = field(
+        default=1_000_000,
+        metadata={"help": "Number of cached rewards kept, evicting the least recently used."},
+    )
+    compile_learner: bool = field(
+        default=True,
+        metadata={
+            "help": "Compile the learner half of the step (log-prob passes, objective and optimizer update). "
+                "Learner batches are padded to multiples of 32 columns and group_size rows, so only a "
+                "few shapes are traced. Only used with the default grpo_loss."
+        },
+    )
+    learner_memory_mb: Optional[float] = field(
+        default=None,
+        metadata={
+            "help": "Activation memory budget of the learner pass in MB. The completions are split into "
+                "micro-batches estimated to fit, and their gradients are accumulated. If `None`, all "
+                "completions of a step go through one pass. Only used with the default grpo_loss."
+        },
+    )
+
+
+def get_per_token_logps(
+    model: nn.Module, inputs, lengths, prompt_length: int = 0, left_padding=None
+):
+    """
+    Log-probabilities of the next tokens of a right-padded batch.
+
+    With ``prompt_length``, the first ``prompt_length`` columns hold prompts
+    that are left-padded by ``left_padding`` and only the tokens after them
+    are scored, so the result lines up with the completions.
+
+    Returns a dense ``(B, L - max(prompt_length, 1))`` array of target
+    log-probs, zero past each row's length, together with the matching
+    boolean mask.
+    """
+    start = max(prompt_length, 1)
+    mask = None
+    if left_padding is not None:
+        mask = make_padded_mask(left_padding, inputs.shape[1])
+    targets = inputs[:, start:]
+    per_token_logps, _, _ = token_logprobs(
+        model, inputs, targets, mask=mask, offset=start - 1
+    )
+    mask = mx.arange(targets.shape[1])[None, :] < (lengths[:, None] - start)
+    return mx.where(mask, per_token_logps, 0.0), mask
+
+
+def learner_micro_batch_size(
+    model: nn.Module, num_rows: int, seq_length: int, memory_mb: float
+) -> int:
+    """
+    Number of rows per learner micro-batch that fit in ``memory_mb``.
+
+    A training pass is estimated to hold about ``34 * hidden_size`` bytes
+    per token and layer of saved activations, plus ``24 * vocab_size`` bytes
+    per position of the one logits chunk that is alive at a time (see
+    ``token_logprobs``). The result is the largest divisor of ``num_rows``
+    that fits (at least 1), so that all micro-batches share one shape.
+    """
+    bytes_per_token = 34 * model.args.hidden_size * len(model.layers)
+    logits_bytes = 24 * model.args.vocab_size * CHUNK_TOKENS
+    budget = max(memory_mb * 1e6 - logits_bytes, 0)
+    max_rows = max(int(budget // (bytes_per_token * seq_length)), 1)
+    return max(
+        rows for rows in range(1, min(max_rows, num_rows) + 1) if num_rows % rows == 0
+    )
 
 
-def get_per_token_logps(model: nn.Module, inputs, lengths):
-    logits = model(inputs).astype(mx.float16)
-    logits = logits[:, :-1, :]
-    targets = inputs[:, 1:]
-    per_token_logps = []
-    for i in range(logits.shape[0]):
-        seq_len = int(lengths[i]) - 1
-        seq_logits = logits[i, :seq_len]
-        seq_targets = targets[i, :seq_len]
-        log_probs = nn.log_softmax(seq_logits, axis=-1)
-        token_log_probs = mx.take_along_axis(
-            log_probs, seq_targets.reshape(seq_len, 1), axis=-1
-        ).squeeze(-1)
-        per_token_logps.append(token_log_probs)
-    mx.eval(logits)
-    return per_token_logps
+def pad_rollouts(
+    prompts: List[List[int]],
+    completions: List[List[int]],
+    pad_to: Optional[int] = None,
+    num_rows: Optional[int] = None,
+):
+    """
+    Lay out (prompt, completion) pairs as one ``(B, P + C)`` batch: prompts
+    are left-padded to the longest prompt ``P`` and completions right-padded
+    to the longest completion ``C``, so every completion starts at column
+    ``P``. The batch is assembled on the host and copied to the device once.
+
+    Args:
+        prompts (List[List[int]]): The prompt token ids of every row.
+        completions (List[List[int]]): The completion token ids of every row.
+        pad_to (int, optional): Round ``P`` and ``C`` up to a multiple of
+          this, so that batches fall into a small set of shapes.
+        num_rows (int, optional): Append empty rows up to this many rows.
+          Empty rows are all left padding and hold no completion tokens.
+
+    Returns:
+        Tuple[mx.array, mx.array, int, Optional[mx.array]]: The batch, the
+        length of every row including its left padding, ``P``, and the left
+        padding of every row (``None`` when no row is padded and no
+        ``pad_to`` is given).
+    """
+    num_rows = max(num_rows or 0, len(completions))
+    prompt_lengths = np.zeros(num_rows, dtype=np.int32)
+    completion_lengths = np.zeros(num_rows, dtype=np.int32)
+    prompt_lengths[: len(prompts)] = [len(ids) for ids in prompts]
+    completion_lengths[: len(completions)] = [len(ids) for ids in completions]
+    prompt_length = int(prompt_lengths.max())
+    completion_length = int(completion_lengths.max())
+    if pad_to is not None:
+        prompt_length = pad_to * -(-prompt_length // pad_to)
+        completion_length = pad_to * max(-(-completion_length // pad_to), 1)
+
+    inputs = np.zeros((num_rows, prompt_length + completion_length), dtype=np.int32)
+    for i, (prompt_ids, completion_ids) in enumerate(zip(prompts, completions)):
+        inputs[i, prompt_length - prompt_lengths[i] : prompt_length] = prompt_ids
+        inputs[i, prompt_length : prompt_length + completion_lengths[i]] = completion_ids
+
+    left_padding = prompt_length - prompt_lengths
+    return (
+        mx.array(inputs),
+        mx.array(prompt_length + completion_lengths),
+        prompt_length,
+        mx.array(left_padding) if pad_to is not None or left_padding.any() else None,
+    )
+
+
+def pad_logprobs(
+    logprobs: List[List[float]],
+    width: Optional[int] = None,
+    num_rows: Optional[int] = None,
+):
+    """
+    Right-pad per-token log-probs into a ``(B, C)`` array with zeros, with
+    at least ``width`` columns and ``num_rows`` rows when given.
+    """
+    padded = np.zeros(
+        (
+            max(num_rows or 0, len(logprobs)),
+            max([width or 0] + [len(lp) for lp in logprobs]),
+        ),
+        dtype=np.float32,
+    )
+    for i, lp in enumerate(logprobs):
+        padded[i, : len(lp)] = lp
+    return mx.array(padded)
+
+
+def informative_completions(
+    func_rewards: List[List[float]],
+    batch_indices: List[int],
+    reward_weights: Optional[List[float]] = None,
+):
+    """
+    Find the completions whose group has some variance in total reward.
+
+    The total reward is the weighted sum of the per-function rewards with
+    missing rewards counted as zero, as in ``grpo_loss``. Groups in which
+    every completion gets the same total have all-zero advantages and do not
+    contribute to the policy gradient.
+
+    Returns:
+        Tuple[List[int], int, int]: The indices of the completions to keep,
+        the number of kept groups and the total number of groups.
+    """
+    weights = np.ones(len(func_rewards)) if reward_weights is None else np.array(reward_weights)
+    totals = np.nan_to_num(np.array(func_rewards, dtype=np.float64), nan=0.0).T @ weights
+
+    groups = {}
+    for i, prompt_idx in enumerate(batch_indices):
+        groups.setdefault(prompt_idx, []).append(i)
+
+    keep = []
+    num_kept = 0
+    for rows in groups.values():
+        if totals[rows].max() > totals[rows].min():
+            keep.extend(rows)
+            num_kept += 1
+    return sorted(keep), num_kept, len(groups)
+
+
+def combine_rollout_stats(
+    stats: Dict[str, float],
+    num_completions: int,
+    more_stats: Dict[str, float],
+    more_completions: int,
+) -> Dict[str, float]:
+    """
+    Stats of two rollouts taken as one. Reward timings (``reward_time`` and
+    the ``<name>_latency`` of every reward function) add up, and every other
+    stat is averaged, weighted by the number of completions.
+    """
+    total = max(num_completions + more_completions, 1)
+    combined = dict(more_stats)
+    for k, v in stats.items():
+        if k not in more_stats:
+            combined[k] = v
+        elif k == "reward_time" or k.endswith("_latency"):
+            combined[k] = v + more_stats[k]
+        else:
+            combined[k] = (v * num_completions + more_stats[k] * more_completions) / total
+    return combined
+
+
+def compute_group_advantages(rewards: mx.array, batch_indices: List[int], eps: float = 1e-4):
+    """
+    Normalize rewards within each prompt's group of completions.
+
+    Groups are given by ``batch_indices`` and may have different sizes. The
+    group statistics are computed with one segment reduction over a one-hot
+    ``(num_completions, num_prompts)`` membership matrix. Completions that
+    are alone in their group get an advantage of zero.
+
+    Returns:
+        Tuple[mx.array, mx.array, mx.array]: The per-completion advantages,
+        and the reward mean and (population) standard deviation per group.
+    """
+    segment_of = {}
+    segment_ids = mx.array([segment_of.setdefault(i, len(segment_of)) for i in batch_indices])
+    membership = (segment_ids[:, None] == mx.arange(len(segment_of))[None, :]).astype(rewards.dtype)
+
+    counts = membership.sum(axis=0)
+    group_means = (rewards @ membership) / counts
+    centered = rewards - group_means[segment_ids]
+    group_stds = mx.sqrt(((centered * centered) @ membership) / counts)
+
+    advantages = mx.where(
+        counts[segment_ids] > 1, centered / (group_stds[segment_ids] + eps), 0.0
+    )
+    return advantages, group_means, group_stds
+
 
 def generate_grpo(
     model: nn.Module,
@@ -106,86 +428,103 @@ def generate_grpo(
     group_size: int,
     temperature: float,
     batch_size: int,
-    end_token: str = "</answer>"
+    end_token: str = "</answer>",
+    num_slots: Optional[int] = None,
 ):
     model.eval()
     all_completions = []
     all_completion_texts = []
+    all_completion_logprobs = []
     batch_indices = []
 
-    total_samples = len(prompt_tokens)
-
-    for i in range(0, total_samples, batch_size):
-        current_batch_size = min(batch_size, total_samples - i)
-        batch_prompts = prompt_tokens[i : i + current_batch_size]
-
-        for j, prompt in enumerate(batch_prompts):
-            for k in range(group_size):
-                prompt_text = tokenizer.decode(prompt)
-                sampler = make_sampler(
-                    temperature,
-                    top_p=1.0,
-                    min_p=0.0,
-                    min_tokens_to_keep=1,
-                    top_k=0,
-                    xtc_probability=0.0,
-                    xtc_threshold=0.0,
-                    xtc_special_tokens=tokenizer.encode("\n") + list(tokenizer.eos_token_ids),
-                )
-
-                prompt_cache = cache.make_prompt_cache(model)
-                completion: str | List[int] = generate(
-                    model=model,
-                    tokenizer=tokenizer,
-                    prompt=prompt_text,
-                    max_tokens=max_tokens,
-                    verbose=False,
-                    sampler=sampler,
-                    prompt_cache=prompt_cache,
-                )
-
+    sampler = make_sampler(
+        temperature,
+        top_p=1.0,
+        min_p=0.0,
+        min_tokens_to_keep=1,
+        top_k=0,
+        xtc_probability=0.0,
+        xtc_threshold=0.0,
+        xtc_special_tokens=tokenizer.encode("\n") + list(tokenizer.eos_token_ids),
+    )
+    end_sequence = tokenizer.encode(end_token) if end_token else []
+
+    # All (prompt, group member) pairs share one continuously refilled decode batch
+    completions, completion_logprobs, rollout_stats = batch_generate(
+        model=model,
+        prompts=prompt_tokens,
+        max_tokens=max_tokens,
+        sampler=sampler,
+        stop_token_ids=list(tokenizer.eos_token_ids),
+        group_size=group_size,
+        num_slots=num_slots or batch_size * group_size,
+        stop_sequences=[end_sequence],
+    )
 
-                if isinstance(completion, str):
-                    completion_ids = tokenizer.encode(completion)
-                else:
-                    completion_ids = completion
+    # Sampled ids are used as-is; text is decoded once, for the reward functions
+    for row, (completion_ids, logprobs) in enumerate(zip(completions, completion_logprobs)):
+        completion = tokenizer.decode(completion_ids)
 
-                if end_token:
-                    end_sequence = tokenizer.encode(end_token)
-                    if len(completion_ids) >= len(end_sequence) and completion_ids[-len(end_sequence):] == end_sequence:
-                        completion_ids = completion_ids[:-len(end_sequence)]
+        if end_sequence:
+            if len(completion_ids) >= len(end_sequence) and completion_ids[-len(end_sequence):] == end_sequence:
+                completion_ids = completion_ids[:-len(end_sequence)]
+                logprobs = logprobs[:-len(end_sequence)]
 
-                completion_ids = mx.array(completion_ids)
-                all_completions.append(mx.stop_gradient(completion_ids))
-                all_completion_texts.append(completion)
-                batch_indices.append(i + j)
+        all_completions.append(completion_ids)
+        all_completion_texts.append(completion)
+        all_completion_logprobs.append(logprobs)
+        batch_indices.append(row // group_size)
 
     mx.clear_cache()
-    return all_completions, all_completion_texts, batch_indices
+    return (
+        all_completions,
+        all_completion_texts,
+        batch_indices,
+        all_completion_logprobs,
+        rollout_stats,
+    )
 
 
-def grpo_loss(
+def prepare_grpo_batch(
     model,
-    ref_model,
     tokenizer,
     batch,
     completions=None,
     completion_texts=None,
     batch_indices=None,
     reward_funcs: Optional[List[RewardFunctions]] = None,
-    beta: float = 0.1,
     group_size: int = 4,
-    epsilon: float = 1e-4,
-    epsilon_high: float = None,
     max_tokens: int = 64,
     temperature: float = 0.8,
     reward_weights: Optional[List[float]] = None,
     batch_size: int = 1,
-    importance_sampling_level: str = "token",
-    grpo_loss_type: str = "grpo",
+    rollout_slots: Optional[int] = None,
+    func_rewards: Optional[List[List[float]]] = None,
+    completion_logprobs: Optional[List[List[float]]] = None,
+    pad_to: Optional[int] = None,
+    pad_rows_to: Optional[int] = None,
+    reward_engine: Optional[RewardEngine] = None,
 ):
+    """
+    Host-side half of the GRPO loss: generate completions if none are given,
+    score them, compute the group advantages and lay everything out as
+    arrays for ``grpo_objective``.
+
+    Rewards that are not given are scored with ``reward_engine``, or with a
+    ``RewardEngine`` of ``reward_funcs`` built for this batch.
+
+    With ``pad_to`` and ``pad_rows_to``, the columns are rounded up to a
+    multiple of ``pad_to`` and the rows to a multiple of ``pad_rows_to``.
+    Padding rows carry no tokens and a zero advantage.
+
+    Returns:
+        Tuple[Dict[str, mx.array], int, Dict]: The array inputs of
+        ``grpo_objective``, the prompt length ``P`` and the reward and
+        rollout metrics.
+    """
     prompt_tokens, _, prompt_text, answer_text, type_info = batch
 
+    rollout_stats = {}
     if (
         completions is not None
         and completion_texts is not None
@@ -195,7 +534,7 @@ def grpo_loss(
         all_completion_texts = completion_texts
         batch_indices = batch_indices
     else:
-        all_completions, all_completion_texts, batch_indices = generate_grpo(
+        all_completions, all_completion_texts, batch_indices, completion_logprobs, rollout_stats = generate_grpo(
             model=model,
             tokenizer=tokenizer,
             prompt_tokens=prompt_tokens,
@@ -203,6 +542,7 @@ def grpo_loss(
             group_size=group_size,
             temperature=temperature,
             batch_size=batch_size,
+            num_slots=rollout_slots,
         )
 
     if not all_completions:
@@ -212,6 +552,7 @@ def grpo_loss(
 
     expanded_answers = []
     expanded_prompts = []
+    expanded_prompt_tokens = []
     expanded_types = []
     unique_prompt_indices = sorted(set(batch_indices))
     grouped_completions = {idx: [] for idx in unique_prompt_indices}
@@ -222,88 +563,64 @@ def grpo_loss(
     ordered_completions = []
     ordered_completion_texts = []
     ordered_batch_indices = []
+    order = []
 
     for prompt_idx in unique_prompt_indices:
         completion_indices = grouped_completions[prompt_idx]
         for idx in completion_indices:
+            order.append(idx)
             ordered_completions.append(all_completions[idx])
             ordered_completion_texts.append(all_completion_texts[idx])
             ordered_batch_indices.append(prompt_idx)
             expanded_answers.append(answer_text[prompt_idx])
             expanded_prompts.append(prompt_text[prompt_idx])
+            expanded_prompt_tokens.append(prompt_tokens[prompt_idx])
             expanded_types.append(type_info[prompt_idx] if type_info is not None else None)
 
     all_completions = ordered_completions
     all_completion_texts = ordered_completion_texts
     batch_indices = ordered_batch_indices
-    max_length = max(ids.shape[0] for ids in all_completions)
-    padded_completions = []
-    attention_masks = []
-
-    for completion_ids in all_completions:
-        completion_tensor = mx.array(completion_ids.tolist())
-        padding_length = max_length - completion_tensor.shape[0]
-        if padding_length > 0:
-            padding = mx.zeros((padding_length,), dtype=completion_tensor.dtype)
-            padded_ids = mx.concatenate([completion_tensor, padding])
-            mask = mx.concatenate(
-                [mx.ones_like(completion_tensor), mx.zeros_like(padding)]
-            )
-        else:
-            padded_ids = completion_tensor
-            mask = mx.ones_like(completion_tensor)
-        padded_completions.append(padded_ids)
-        attention_masks.append(mask)
-
-    inputs = mx.stack(padded_completions)
-    attention_mask = mx.stack(attention_masks)
-    lengths = attention_mask.sum(axis=1)
-
-    token_log_probs = get_per_token_logps(model, inputs, lengths)
-    mx.eval(token_log_probs)
-
-    if ref_model is None:
-        ref_token_log_probs = token_log_probs
-    else:
-        ref_token_log_probs = get_per_token_logps(ref_model, inputs, lengths)
-        mx.eval(ref_token_log_probs)
-
-    max_len = max(x.shape[0] for x in token_log_probs)
-    padded_log_probs = []
-    padded_ref_log_probs = []
-
-    for i in range(len(token_log_probs)):
-        seq_len = token_log_probs[i].shape[0]
-        padding = mx.zeros((max_len - seq_len,))
-
-        padded_log_probs.append(mx.concatenate([token_log_probs[i], padding]))
-        padded_ref_log_probs.append(mx.concatenate([ref_token_log_probs[i], padding]))
-
-    token_log_probs = mx.stack(padded_log_probs)
-    ref_token_log_probs = mx.stack(padded_ref_log_probs)
+    num_sequences = len(all_completions)
+    num_rows = None
+    if pad_rows_to is not None:
+        num_rows = pad_rows_to * -(-num_sequences // pad_rows_to)
+    inputs, lengths, prompt_length, left_padding = pad_rollouts(
+        expanded_prompt_tokens, all_completions, pad_to=pad_to, num_rows=num_rows
+    )
 
-    all_func_rewards = []
-    cached_raw_rewards = []  # Cache for metrics calculation
+    # Log-probs recorded while sampling, the old policy of stale rollouts
+    rollout_token_log_probs = None
+    if completion_logprobs is not None:
+        rollout_token_log_probs = pad_logprobs(
+            [completion_logprobs[i] for i in order],
+            width=inputs.shape[1] - prompt_length,
+            num_rows=inputs.shape[0],
+        )
 
     print(f"Response: {all_completion_texts[0]}")
 
-    for reward_func in reward_funcs:
-        raw_rewards = reward_func(
+    if func_rewards is None:
+        engine = reward_engine or RewardEngine(reward_funcs, tokenizer=tokenizer)
+        func_rewards, timings = engine.score(
             prompts=expanded_prompts,
             completions=all_completion_texts,
-            answer=expanded_answers,
-            types=expanded_types
+            answers=expanded_answers,
+            types=expanded_types,
+            completion_ids=all_completions,
         )
-        cached_raw_rewards.append(raw_rewards)  # Cache the results
-        if raw_rewards is None:
-            processed_rewards = [float('nan')] * len(all_completion_texts)
-        else:
-            processed_rewards = [float(r) if r is not None else float('nan') for r in raw_rewards]
-        func_rewards = mx.array(processed_rewards)
-        all_func_rewards.append(func_rewards)
+        rollout_stats = {**rollout_stats, **timings}
+        if reward_engine is None:
+            engine.shutdown()
+    else:
+        # Precomputed rewards follow the order the completions were passed in
+        func_rewards = [[rewards[i] for i in order] for rewards in func_rewards]
+
+    all_func_rewards = []
+    for reward_func, processed_rewards in zip(reward_funcs, func_rewards):
+        all_func_rewards.append(mx.array(processed_rewards))
 
-        if raw_rewards and any(r is not None for r in raw_rewards):
-            valid_rewards = [r for r in raw_rewards if r is not None]
+        valid_rewards = [r for r in processed_rewards if not np.isnan(r)]
+        if valid_rewards:
             wandb.log({
                 f"{reward_func.__name__}_mean": sum(valid_rewards) / len(valid_rewards),
                 f"{reward_func.__name__}_std": np.std(valid_rewards) if len(valid_rewards) > 1 else 0.0,
@@ -338,42 +655,127 @@ def grpo_loss(
     rewards_no_nan = mx.where(valid_reward_mask, rewards, mx.zeros_like(rewards))
     rewards = (rewards_no_nan * mx.expand_dims(reward_weights, 0)).sum(axis=1)
 
-    num_unique_prompts = len(unique_prompt_indices)
+    advantages, grouped_rewards_mean, grouped_rewards_std = compute_group_advantages(
+        rewards, batch_indices
+    )
+    if inputs.shape[0] > num_sequences:
+        advantages = mx.concatenate(
+            [advantages, mx.zeros(inputs.shape[0] - num_sequences, dtype=advantages.dtype)]
+        )
 
-    rewards_by_prompt = [[] for _ in range(num_unique_prompts)]
-    for i, prompt_idx in enumerate(batch_indices):
-        prompt_position = unique_prompt_indices.index(prompt_idx)
-        rewards_by_prompt[prompt_position].append(rewards[i])
-
-    advantages = mx.zeros_like(rewards)
-    for i, prompt_rewards in enumerate(rewards_by_prompt):
-        if len(prompt_rewards) > 1:
-            prompt_rewards = mx.array(prompt_rewards)
-            mean_reward = mx.mean(prompt_rewards)
-            std_reward = mx.std(prompt_rewards)
-            indices = [
-                j
-                for j, idx in enumerate(batch_indices)
-                if idx == unique_prompt_indices[i]
-            ]
-            for j, idx in enumerate(indices):
-                advantages[idx] = (prompt_rewards[j] - mean_reward) / (
-                    std_reward + 1e-4
-                )
+    reward_metrics = {}
+    for i, reward_func in enumerate(reward_funcs):
+        func_name = reward_func.__name__
+        valid_rewards = mx.array([r for r in func_rewards[i] if not np.isnan(r)])
+        if len(valid_rewards) > 0:
+            reward_metrics[f"{func_name}_mean"] = mx.mean(valid_rewards)
+            reward_metrics[f"{func_name}_std"] = mx.std(valid_rewards) if len(valid_rewards) > 1 else mx.zeros(1)
+            reward_metrics[f"{func_name}_coverage"] = mx.array(len(valid_rewards) / len(func_rewards[i]))
         else:
-            idx = batch_indices.index(unique_prompt_indices[i])
-            advantages[idx] = 0.0
+            reward_metrics[f"{func_name}_mean"] = float('nan')
+            reward_metrics[f"{func_name}_std"] = float('nan')
+            reward_metrics[f"{func_name}_coverage"] = 0.0
+
+    metrics = {
+        "total_rewards_mean": mx.mean(rewards),
+        "total_rewards_std": mx.std(rewards),
+        "grouped_rewards_mean": mx.mean(grouped_rewards_mean),
+        "grouped_rewards_std": mx.mean(grouped_rewards_std),
+        "average_generated_tokens": len(all_completion_texts) // len(batch_indices),
+        **reward_metrics,
+        **rollout_stats,
+    }
+
+    learner_batch = {
+        "inputs": inputs,
+        "lengths": lengths,
+        "left_padding": left_padding,
+        "advantages": advantages,
+        "rollout_token_log_probs": rollout_token_log_probs,
+        "num_sequences": mx.array(num_sequences, dtype=mx.float32),
+        "num_tokens": mx.array(sum(len(ids) for ids in all_completions), dtype=mx.float32),
+        "num_scored_sequences": mx.array(
+            sum(len(ids) > 0 for ids in all_completions), dtype=mx.float32
+        ),
+    }
+    return learner_batch, prompt_length, metrics
+
+
+def grpo_objective(
+    model,
+    ref_model,
+    inputs,
+    lengths,
+    left_padding,
+    advantages,
+    rollout_token_log_probs,
+    num_sequences,
+    num_tokens,
+    num_scored_sequences,
+    prompt_length: int,
+    beta: float = 0.1,
+    epsilon: float = 1e-4,
+    epsilon_high: float = None,
+    max_tokens: int = 64,
+    importance_sampling_level: str = "token",
+    grpo_loss_type: str = "grpo",
+    use_rollout_logprobs: bool = False,
+    stale_rollout: bool = False,
+):
+    """
+    Array half of the GRPO loss: the policy and reference log-prob passes,
+    the KL penalty, the clipped objective and the loss reduction.
+
+    It only does array work with shapes fixed by its inputs, so it can be
+    traced by ``mx.compile``. Rows without completion tokens (such as the
+    padding rows of ``prepare_grpo_batch``) contribute nothing.
+
+    The loss and metrics are normalized by the counts of the whole batch
+    (``num_sequences``, ``num_tokens`` and ``num_scored_sequences``), so
+    when the rows are split into micro-batches, summing the results of the
+    micro-batches gives the result of the whole batch.
+
+    The old policy of the importance ratio is the policy itself (without
+    gradient) for fresh rollouts. Decoding with a KV cache is not
+    numerically identical to the full-sequence pass, so the sampling
+    log-probs ``rollout_token_log_probs`` are only used as the old policy
+    when ``stale_rollout`` is set, for rollouts sampled before the last
+    update. Otherwise they only feed the ``rollout_logprob_diff`` metric.
+
+    Returns:
+        Tuple[mx.array, mx.array, Dict[str, mx.array]]: The loss, the number
+        of completion tokens, and the KL and clipping metrics.
+    """
+    if use_rollout_logprobs and rollout_token_log_probs is not None:
+        # Without gradients the sampling log-probs stand in for the policy pass
+        token_log_probs = rollout_token_log_probs
+        length_mask = mx.arange(inputs.shape[1] - prompt_length)[None, :] < (
+            lengths[:, None] - prompt_length
+        )
+    else:
+        token_log_probs, length_mask = get_per_token_logps(
+            model, inputs, lengths, prompt_length, left_padding
+        )
+
+    if ref_model is None:
+        ref_token_log_probs = token_log_probs
+    else:
+        ref_token_log_probs, _ = get_per_token_logps(
+            ref_model, inputs, lengths, prompt_length, left_padding
+        )
+        ref_token_log_probs = mx.stop_gradient(ref_token_log_probs)
 
     # Compute KL divergence using Schulman's approximator
     kl_div = (
         mx.exp(ref_token_log_probs - token_log_probs) - (ref_token_log_probs - token_log_probs) - 1
     )
 
-    # Create mask for valid tokens
-    length_mask = mx.arange(inputs.shape[1] - 1)[None, :] < (lengths[:, None] - 1)
-
-    # Compute log ratio for importance sampling
-    log_ratio = token_log_probs - mx.stop_gradient(ref_token_log_probs)
+    # Compute log ratio for importance sampling, against the sampling policy for stale rollouts
+    if stale_rollout and rollout_token_log_probs is not None:
+        old_token_log_probs = rollout_token_log_probs
+    else:
+        old_token_log_probs = token_log_probs
+    log_ratio = token_log_probs - mx.stop_gradient(old_token_log_probs)
 
     # Apply importance sampling based on level
     if importance_sampling_level == "token":
@@ -404,7 +806,6 @@ def grpo_loss(
     )
     is_region_clipped = is_low_clipped | is_high_clipped
 
-
     # Calculate both unclipped and clipped objectives
     unclipped_obj = coef_1 * advantages.reshape(-1, 1)
     clipped_obj = coef_2 * advantages.reshape(-1, 1)
@@ -416,75 +817,107 @@ def grpo_loss(
     if beta != 0.0:
         per_token_loss = per_token_loss + beta * kl_div
 
+    # Counts are clamped instead of branched on, so the graph does not depend on values
+    row_tokens = length_mask.sum(axis=1)
+    num_tokens = mx.maximum(num_tokens, 1)
 
-    if grpo_loss_type == "grpo":
-        loss = (per_token_loss * length_mask).sum() / length_mask.sum()
-    elif grpo_loss_type == "bnpo":
-        loss = (per_token_loss * length_mask).sum() / mx.maximum(length_mask.sum(), 1.0)
+    if grpo_loss_type in ("grpo", "bnpo"):
+        loss = (per_token_loss * length_mask).sum() / num_tokens
     elif grpo_loss_type == "dr_grpo":
-        loss = (per_token_loss * length_mask).sum() / (per_token_loss.shape[0] * max_tokens)
+        loss = (per_token_loss * length_mask).sum() / (num_sequences * max_tokens)
     else:
         raise ValueError(f"Unknown loss type: {grpo_loss_type}")
 
-    # Calculate mean KL divergence for metrics
-    mean_kl = ((kl_div * length_mask).sum(axis=1) / length_mask.sum(axis=1)).mean()
-
-    reward_metrics = {}
-    for i, reward_func in enumerate(reward_funcs):
-        func_name = reward_func.__name__
-        raw_rewards = cached_raw_rewards[i]  # Use cached results instead of recomputing!
-        valid_mask = ~mx.isnan(mx.array([reward if reward is not None else float('nan') for reward in raw_rewards]))
-        valid_rewards = mx.array([reward for reward in raw_rewards if reward is not None and not mx.isnan(reward)])
-        if len(valid_rewards) > 0:
-            reward_metrics[f"{func_name}_mean"] = mx.mean(valid_rewards)
-            reward_metrics[f"{func_name}_std"] = mx.std(valid_rewards) if len(valid_rewards) > 1 else mx.zeros(1)
-            reward_metrics[f"{func_name}_coverage"] = valid_mask.sum() / len(raw_rewards)
-        else:
-            reward_metrics[f"{func_name}_mean"] = float('nan')
-            reward_metrics[f"{func_name}_std"] = float('nan')
-            reward_metrics[f"{func_name}_coverage"] = 0.0
-
-    grouped_rewards_mean = mx.array(
-        [mx.mean(mx.array(rewards)) for rewards in rewards_by_prompt]
-    )
-    grouped_rewards_std = mx.array(
-        [
-            mx.std(mx.array(rewards)) if len(rewards) > 1 else mx.zeros(1)
-            for rewards in rewards_by_prompt
-        ]
-    )
+    # Calculate mean KL divergence over the rows that hold completion tokens
+    row_kl = (kl_div * length_mask).sum(axis=1) / mx.maximum(row_tokens, 1)
+    mean_kl = row_kl.sum() / mx.maximum(num_scored_sequences, 1)
 
     metrics = {
-        "total_rewards_mean": mx.mean(rewards),
-        "total_rewards_std": mx.std(rewards),
-        "grouped_rewards_mean": mx.mean(grouped_rewards_mean),
-        "grouped_rewards_std": mx.mean(grouped_rewards_std),
         "kl": mean_kl,
-        "average_generated_tokens": len(all_completion_texts) // len(batch_indices),
-        "clip_ratio_low": (
-            (is_low_clipped * length_mask).sum() / length_mask.sum()
-            if length_mask.sum() > 0
-            else mx.zeros(1)
-        ),
-        "clip_ratio_high": (
-            (is_high_clipped * length_mask).sum() / length_mask.sum()
-            if length_mask.sum() > 0
-            else mx.zeros(1)
-        ),
-        "clip_ratio_total": (
-            (is_region_clipped * length_mask).sum() / length_mask.sum()
-            if length_mask.sum() > 0
-            else mx.zeros(1)
-        ),
-        **reward_metrics,
+        "clip_ratio_low": (is_low_clipped * length_mask).sum() / num_tokens,
+        "clip_ratio_high": (is_high_clipped * length_mask).sum() / num_tokens,
+        "clip_ratio_total": (is_region_clipped * length_mask).sum() / num_tokens,
     }
+    if rollout_token_log_probs is not None:
+        metrics["rollout_logprob_diff"] = (
+            mx.abs(mx.stop_gradient(token_log_probs) - rollout_token_log_probs) * length_mask
+        ).sum() / num_tokens
+
+    return loss, row_tokens.sum(), metrics
+
+
+def grpo_loss(
+    model,
+    ref_model,
+    tokenizer,
+    batch,
+    completions=None,
+    completion_texts=None,
+    batch_indices=None,
+    reward_funcs: Optional[List[RewardFunctions]] = None,
+    beta: float = 0.1,
+    group_size: int = 4,
+    epsilon: float = 1e-4,
+    epsilon_high: float = None,
+    max_tokens: int = 64,
+    temperature: float = 0.8,
+    reward_weights: Optional[List[float]] = None,
+    batch_size: int = 1,
+    importance_sampling_level: str = "token",
+    grpo_loss_type: str = "grpo",
+    rollout_slots: Optional[int] = None,
+    func_rewards: Optional[List[List[float]]] = None,
+    completion_logprobs: Optional[List[List[float]]] = None,
+    use_rollout_logprobs: bool = False,
+    stale_rollout: bool = False,
+    reward_engine: Optional[RewardEngine] = None,
+):
+    learner_batch, prompt_length, metrics = prepare_grpo_batch(
+        model,
+        tokenizer,
+        batch,
+        completions=completions,
+        completion_texts=completion_texts,
+        batch_indices=batch_indices,
+        reward_funcs=reward_funcs,
+        group_size=group_size,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        reward_weights=reward_weights,
+        batch_size=batch_size,
+        rollout_slots=rollout_slots,
+        func_rewards=func_rewards,
+        completion_logprobs=completion_logprobs,
+        reward_engine=reward_engine,
+    )
+
+    loss, ntoks, objective_metrics = grpo_objective(
+        model,
+        ref_model,
+        **learner_batch,
+        prompt_length=prompt_length,
+        beta=beta,
+        epsilon=epsilon,
+        epsilon_high=epsilon_high,
+        max_tokens=max_tokens,
+        importance_sampling_level=importance_sampling_level,
+        grpo_loss_type=grpo_loss_type,
+        use_rollout_logprobs=use_rollout_logprobs,
+        stale_rollout=stale_rollout,
+    )
 
     mx.clear_cache()
 
-    return loss, length_mask.sum(axis=1).sum(), metrics
+    return loss, ntoks, {**metrics, **objective_metrics}
 
 
-def iterate_grpo_batches(dataset, batch_size, max_seq_length, train=False):
+def iterate_grpo_batches(
+    dataset,
+    batch_size,
+    max_seq_length,
+    train=False,
+    sampler: Optional[BatchSampler] = None,
+):
     has_types = isinstance(dataset[0], tuple) and len(dataset[0]) == 5
 
     if not dataset or not isinstance(dataset[0], tuple) or (not has_types and len(dataset[0]) != 4):
@@ -507,18 +940,14 @@ def iterate_grpo_batches(dataset, batch_size, max_seq_length, train=False):
     if batch_size % step != 0:
         raise ValueError("The batch size must be divisible by the number of workers")
 
-    def batch_index_generator():
-        for i in range(0, len(idx) - batch_size + 1, batch_size):
-            yield idx[i : i + batch_size : step]
+    if sampler is None:
+        sampler = BatchSampler(shuffle=train)
+    sampler.set_batches(
+        [idx[i : i + batch_size : step] for i in range(0, len(idx) - batch_size + 1, batch_size)]
+    )
 
     while True:
-        indices = (
-            np.random.permutation(list(batch_index_generator()))
-            if train
-            else batch_index_generator()
-        )
-
-        for batch_idx in indices:
+        for batch_idx in sampler:
             current_batch = [dataset[j] for j in batch_idx]
 
             prompts_tokens = [item[0] for item in current_batch]
@@ -558,7 +987,21 @@ def evaluate_grpo(
     iterate_batches: callable = iterate_grpo_batches,
     grpo_loss_type: str = "grpo",
     importance_sampling_level: str = "token",
+    rollout_slots: Optional[int] = None,
+    reward_engine: Optional[RewardEngine] = None,
 ):
+    """
+    Evaluate the GRPO loss on freshly generated completions.
+
+    The rewards are scored with ``reward_engine``, so validation gets the
+    same concurrency, timeouts and failure policies as training. Without
+    one, a ``RewardEngine`` of ``reward_funcs`` with default settings is
+    used.
+    """
+    owns_engine = reward_engine is None
+    if owns_engine:
+        reward_engine = RewardEngine(reward_funcs, tokenizer=tokenizer)
+
     all_losses = 0
     ntokens = 0
     all_metrics = None
@@ -587,6 +1030,10 @@ def evaluate_grpo(
             max_tokens=max_tokens,
             importance_sampling_level=importance_sampling_level,
             grpo_loss_type=grpo_loss_type,
+            batch_size=batch_size,
+            rollout_slots=rollout_slots,
+            use_rollout_logprobs=True,
+            reward_engine=reward_engine,
         )
 
         all_losses += losses * toks
@@ -600,6 +1047,9 @@ def evaluate_grpo(
 
         mx.eval(all_losses, ntokens)
 
+    if owns_engine:
+        reward_engine.shutdown()
+
     all_losses = mx.distributed.all_sum(all_losses, stream=mx.cpu)
     ntokens = mx.distributed.all_sum(ntokens, stream=mx.cpu)
     all_metrics = {k: mx.distributed.all_sum(v) for k, v in all_metrics.items()}
@@ -640,46 +1090,336 @@ def train_grpo(
     if args.grad_checkpoint:
         grad_checkpoint(model.layers[0])
 
-    state = [model.state, optimizer.state]
-
-    def step(batch):
-        prompt_tokens, targets, prompt_lens, target_lens, type_info = batch
+    if args.probe_group_size is not None and not 2 <= args.probe_group_size <= args.group_size:
+        raise ValueError(
+            f"probe_group_size ({args.probe_group_size}) must be at least 2 and at most "
+            f"group_size ({args.group_size})."
+        )
 
-        all_completions, all_completion_texts, batch_indices = generate_grpo(
+    if args.replay_passes < 1:
+        raise ValueError(f"replay_passes must be at least 1, got {args.replay_passes}.")
+
+    reward_cache = None
+    if args.reward_cache_path is not None:
+        reward_cache = RewardCache(args.reward_cache_path, args.reward_cache_max_entries)
+        reward_funcs = [reward_cache.wrap(reward_func) for reward_func in reward_funcs]
+
+    # Runs the reward functions of a batch concurrently
+    reward_engine = RewardEngine(
+        reward_funcs,
+        timeouts=args.reward_timeouts,
+        failure_policies=args.reward_failure_policies,
+        max_workers=args.reward_workers,
+        async_concurrency=args.reward_async_concurrency,
+        tokenizer=tokenizer,
+    )
+    # Scores rollouts off the main thread in pipelined mode
+    reward_executor = ThreadPoolExecutor(max_workers=1) if args.pipeline_rollouts else None
+
+    def sample_groups(batch, prompt_ids, group_size):
+        prompt_tokens = batch[0]
+
+        (
+            all_completions,
+            all_completion_texts,
+            batch_indices,
+            completion_logprobs,
+            rollout_stats,
+        ) = generate_grpo(
             model=model,
             tokenizer=tokenizer,
-            prompt_tokens=prompt_tokens,
+            prompt_tokens=[prompt_tokens[i] for i in prompt_ids],
             max_tokens=args.max_completion_length,
-            group_size=args.group_size,
+            group_size=group_size,
             temperature=args.temperature,
             batch_size=args.batch_size,
+            num_slots=args.rollout_slots or args.batch_size * args.group_size,
         )
 
         mx.clear_cache()
 
-        (lvalue, toks, metrics), grad = loss_value_and_grad(
+        return {
+            "batch": batch,
+            "completions": all_completions,
+            "completion_texts": all_completion_texts,
+            "batch_indices": [prompt_ids[i] for i in batch_indices],
+            "completion_logprobs": completion_logprobs,
+            "rollout_stats": rollout_stats,
+            "func_rewards": None,
+        }
+
+    def score_args(rollout_batch):
+        _, _, prompt_text, answer_text, type_info = rollout_batch["batch"]
+        batch_indices = rollout_batch["batch_indices"]
+        return dict(
+            prompts=[prompt_text[i] for i in batch_indices],
+            completions=rollout_batch["completion_texts"],
+            answers=[answer_text[i] for i in batch_indices],
+            types=[type_info[i] for i in batch_indices] if type_info is not None else None,
+            completion_ids=rollout_batch["completions"],
+        )
+
+    def adaptive_rollout(batch):
+        """
+        Probe every prompt with a small group and spend the rest of the
+        rollout budget only on prompts whose probe rewards disagree.
+        """
+        num_prompts = len(batch[0])
+        rollout_batch = sample_groups(batch, list(range(num_prompts)), args.probe_group_size)
+        rollout_batch["func_rewards"], timings = reward_engine.score(**score_args(rollout_batch))
+
+        keep, _, _ = informative_completions(
+            rollout_batch["func_rewards"],
+            rollout_batch["batch_indices"],
+            args.reward_weights,
+        )
+        informative = sorted(set(rollout_batch["batch_indices"][i] for i in keep))
+
+        budget = args.rollout_budget or args.batch_size * args.group_size
+        extra = args.group_size - args.probe_group_size
+        if extra > 0:
+            informative = informative[: max(budget - len(rollout_batch["completions"]), 0) // extra]
+        else:
+            informative = []
+
+        if informative:
+            more = sample_groups(batch, informative, extra)
+            more["func_rewards"], more_timings = reward_engine.score(**score_args(more))
+            timings = {k: v + more_timings[k] for k, v in timings.items()}
+
+            num_probe, num_more = len(rollout_batch["completions"]), len(more["completions"])
+            for key in ["completions", "completion_texts", "batch_indices", "completion_logprobs"]:
+                rollout_batch[key] = rollout_batch[key] + more[key]
+            rollout_batch["func_rewards"] = [
+                a + b for a, b in zip(rollout_batch["func_rewards"], more["func_rewards"])
+            ]
+            rollout_batch["rollout_stats"] = combine_rollout_stats(
+                rollout_batch["rollout_stats"], num_probe, more["rollout_stats"], num_more
+            )
+
+        rollout_batch["rollout_stats"]["adaptive_group_size_mean"] = (
+            len(rollout_batch["completions"]) / num_prompts
+        )
+        rollout_batch["rollout_stats"].update(timings)
+        return rollout_batch
+
+    def add_rewards(rollout_batch, scored):
+        func_rewards, timings = scored
+        rollout_batch["func_rewards"] = func_rewards
+        rollout_batch["rollout_stats"] = {**rollout_batch["rollout_stats"], **timings}
+        return rollout_batch
+
+    def rollout(batch, score_in_background=True):
+        if args.probe_group_size:
+            return adaptive_rollout(batch)
+
+        rollout_batch = sample_groups(batch, list(range(len(batch[0]))), args.group_size)
+        if reward_executor is not None and score_in_background:
+            rollout_batch["func_rewards"] = reward_executor.submit(
+                reward_engine.score, **score_args(rollout_batch)
+            )
+            return rollout_batch
+        return add_rewards(rollout_batch, reward_engine.score(**score_args(rollout_batch)))
+
+    def select_completions(rollout_batch, keep):
+        rollout_batch = dict(rollout_batch)
+        for key in ["completions", "completion_texts", "batch_indices", "completion_logprobs"]:
+            rollout_batch[key] = [rollout_batch[key][i] for i in keep]
+        rollout_batch["func_rewards"] = [
+            [rewards[i] for i in keep] for rewards in rollout_batch["func_rewards"]
+        ]
+        return rollout_batch
+
+    def merge_rollouts(first, second):
+        offset = len(first["batch"][0])
+        merged = {
+            "batch": tuple(
+                a + b if a is not None else None
+                for a, b in zip(first["batch"], second["batch"])
+            ),
+            "batch_indices": first["batch_indices"] + [i + offset for i in second["batch_indices"]],
+            "func_rewards": [a + b for a, b in zip(first["func_rewards"], second["func_rewards"])],
+        }
+        for key in ["completions", "completion_texts", "completion_logprobs"]:
+            merged[key] = first[key] + second[key]
+        return merged
+
+    def dynamic_sample(rollout_batch):
+        """
+        Drop zero-variance groups and top the batch up with fresh rollouts.
+        """
+        kept = None
+        num_kept = 0
+        num_groups = 0
+        # Stats and timings of every rollout, including refills that add nothing
+        stats = rollout_batch["rollout_stats"]
+        num_generated = len(rollout_batch["completions"])
+        for refill in range(args.dynamic_sampling_max_refills + 1):
+            if refill > 0:
+                if num_kept >= args.batch_size:
+                    break
+                rollout_batch = rollout(next_batch(), score_in_background=False)
+                stats = combine_rollout_stats(
+                    stats, num_generated,
+                    rollout_batch["rollout_stats"], len(rollout_batch["completions"]),
+                )
+                num_generated += len(rollout_batch["completions"])
+            keep, group_kept, group_total = informative_completions(
+                rollout_batch["func_rewards"],
+                rollout_batch["batch_indices"],
+                args.reward_weights,
+            )
+            num_kept += group_kept
+            num_groups += group_total
+            if keep:
+                selected = select_completions(rollout_batch, keep)
+                kept = selected if kept is None else merge_rollouts(kept, selected)
+
+        filtered_fraction = 1.0 - num_kept / num_groups
+        if kept is None:
+            # Nothing informative was sampled; train on the last rollout as-is
+            kept = rollout_batch
+        else:
+            # Keep at most batch_size groups
+            groups = sorted(set(kept["batch_indices"]))[: args.batch_size]
+            kept = select_completions(
+                kept, [i for i, g in enumerate(kept["batch_indices"]) if g in groups]
+            )
+        kept["rollout_stats"] = stats
+        return kept, filtered_fraction
+
+    def finalize(rollout_batch):
+        """
+        Wait for the rollout's rewards and apply dynamic sampling, so that it
+        is ready to be trained on (and replayed) as-is.
+        """
+        func_rewards = rollout_batch["func_rewards"]
+        if isinstance(func_rewards, Future):
+            rollout_batch = add_rewards(dict(rollout_batch), func_rewards.result())
+
+        if args.dynamic_sampling:
+            rollout_batch, filtered_fraction = dynamic_sample(rollout_batch)
+            rollout_batch["rollout_stats"] = dict(
+                rollout_batch["rollout_stats"],
+                dynamic_sampling_filtered_fraction=filtered_fraction,
+            )
+        return rollout_batch
+
+    use_objective = loss_fn is grpo_loss
+    micro_batching = use_objective and args.learner_memory_mb is not None
+
+    accumulator = GradientAccumulator(
+        model, optimizer, args.gradient_accumulation_steps, chunked=micro_batching
+    )
+    compile_state = [model.state, optimizer.state, mx.random.state, accumulator.state]
+    if isinstance(ref_model, nn.Module) and ref_model is not model:
+        compile_state.append(ref_model.state)
+
+    objective_value_and_grad = nn.value_and_grad(model, grpo_objective)
+
+    def learner_step(learner_batch, prompt_length, update, stale_rollout):
+        (lvalue, toks, metrics), grad = objective_value_and_grad(
             model,
-            tokenizer=tokenizer,
-            batch=(prompt_tokens, targets, prompt_lens, target_lens, type_info),
-            completions=all_completions,
-            completion_texts=all_completion_texts,
-            batch_indices=batch_indices,
-            reward_funcs=reward_funcs,
+            ref_model,
+            **learner_batch,
+            prompt_length=prompt_length,
             beta=args.beta,
-            group_size=args.group_size,
             epsilon=args.epsilon,
             epsilon_high=args.epsilon_high,
-            ref_model=ref_model,
-            grpo_loss_type=args.grpo_loss_type,
             max_tokens=args.max_completion_length,
             importance_sampling_level=args.importance_sampling_level,
+            grpo_loss_type=args.grpo_loss_type,
+            stale_rollout=stale_rollout,
+        )
+
+        accumulator.accumulate(grad, update)
+        return lvalue, toks, metrics
+
+    if args.compile_learner:
+        learner_step = mx.compile(learner_step, inputs=compile_state, outputs=compile_state)
+
+    def objective_step(rollout_batch, stale_rollout):
+        # Rollout bookkeeping and rewards stay on the host; only the learner pass is compiled
+        learner_batch, prompt_length, metrics = prepare_grpo_batch(
+            model,
+            tokenizer,
+            batch=rollout_batch["batch"],
+            completions=rollout_batch["completions"],
+            completion_texts=rollout_batch["completion_texts"],
+            batch_indices=rollout_batch["batch_indices"],
+            func_rewards=rollout_batch["func_rewards"],
+            completion_logprobs=rollout_batch["completion_logprobs"],
+            reward_funcs=reward_funcs,
+            reward_weights=args.reward_weights,
+            group_size=args.group_size,
+            max_tokens=args.max_completion_length,
+            pad_to=32,
+            pad_rows_to=args.group_size,
         )
 
-        if (it + 1) % args.gradient_accumulation_steps == 0:
-            grad = average_gradients(grad)
-            optimizer.update(model, grad)
+        num_rows, seq_length = learner_batch["inputs"].shape
+        micro_batch_size = num_rows
+        if micro_batching:
+            micro_batch_size = learner_micro_batch_size(
+                model, num_rows, seq_length, args.learner_memory_mb
+            )
+
+        update = accumulator.advance()
+        lvalue, toks, objective_metrics = 0, 0, {}
+        for start in range(0, num_rows, micro_batch_size):
+            micro_batch = {
+                k: v if v is None or v.ndim == 0 else v[start : start + micro_batch_size]
+                for k, v in learner_batch.items()
+            }
+            last = start + micro_batch_size >= num_rows
+            micro_lvalue, micro_toks, micro_metrics = learner_step(
+                micro_batch, prompt_length, update and last, stale_rollout
+            )
+            lvalue += micro_lvalue
+            toks += micro_toks
+            for k, v in micro_metrics.items():
+                objective_metrics[k] = objective_metrics.get(k, 0) + v
+            if not last:
+                # Free the micro-batch's activations before the next one
+                mx.eval(compile_state, lvalue, toks, objective_metrics)
+
+        return lvalue, toks, {**metrics, **objective_metrics}
+
+    # Pipelined and replayed rollouts were sampled before the last update
+    stale_rollouts = args.pipeline_rollouts or args.replay_passes > 1 or args.replay_max_age > 0
+
+    def step(rollout_batch):
+        if use_objective:
+            lvalue, toks, metrics = objective_step(rollout_batch, stale_rollouts)
+        else:
+            (lvalue, toks, metrics), grad = loss_value_and_grad(
+                model,
+                tokenizer=tokenizer,
+                batch=rollout_batch["batch"],
+                completions=rollout_batch["completions"],
+                completion_texts=rollout_batch["completion_texts"],
+                batch_indices=rollout_batch["batch_indices"],
+                func_rewards=rollout_batch["func_rewards"],
+                completion_logprobs=rollout_batch["completion_logprobs"],
+                reward_funcs=reward_funcs,
+                reward_weights=args.reward_weights,
+                beta=args.beta,
+                group_size=args.group_size,
+                epsilon=args.epsilon,
+                epsilon_high=args.epsilon_high,
+                ref_model=ref_model,
+                grpo_loss_type=args.grpo_loss_type,
+                max_tokens=args.max_completion_length,
+                importance_sampling_level=args.importance_sampling_level,
+                stale_rollout=stale_rollouts,
+            )
+
+            accumulator.accumulate(grad, accumulator.advance())
 
-        return (lvalue / args.gradient_accumulation_steps), toks, metrics
+        metrics.update(rollout_batch["rollout_stats"])
+        if reward_cache is not None:
+            metrics.update(reward_cache.pop_stats())
+        return lvalue, toks, metrics
 
     loss_value_and_grad = nn.value_and_grad(model, loss_fn)
 
@@ -697,23 +1437,66 @@ def train_grpo(
         "clip_ratio_low": 0,
         "clip_ratio_high": 0,
         "clip_ratio_total": 0,
+        "rollout_logprob_diff": 0,
+        "rollout_slot_occupancy": 0,
     }
+    if args.dynamic_sampling:
+        accumulated_metrics["dynamic_sampling_filtered_fraction"] = 0
+    if args.probe_group_size:
+        accumulated_metrics["adaptive_group_size_mean"] = 0
+
+    replay_buffer = None
+    if args.replay_passes > 1 or args.replay_max_age > 0:
+        replay_buffer = RolloutReplayBuffer(
+            max_age=args.replay_max_age,
+            max_bytes=int(args.replay_buffer_mb * 1e6) if args.replay_buffer_mb else None,
+        )
+        accumulated_metrics["replay_buffer_size"] = 0
+        accumulated_metrics["replay_sample_age"] = 0
     for reward_func in reward_funcs:
         func_name = reward_func.__name__
         accumulated_metrics[f"{func_name}_mean"] = 0
         accumulated_metrics[f"{func_name}_std"] = 0
         accumulated_metrics[f"{func_name}_coverage"] = 0
+        accumulated_metrics[f"{func_name}_latency"] = 0
+    accumulated_metrics["reward_time"] = 0
+    if reward_cache is not None:
+        accumulated_metrics["reward_cache_hits"] = 0
+        accumulated_metrics["reward_cache_misses"] = 0
+        accumulated_metrics["reward_cache_hit_rate"] = 0
+
+    # One persistent iterator: the dataset is sorted once and epochs are walked in order
+    sampler = BatchSampler()
+    if args.sampler_state_file is not None:
+        sampler.load(args.sampler_state_file)
+    train_batches = iterate_batches(
+        dataset=train_dataset,
+        batch_size=args.batch_size,
+        max_seq_length=args.max_seq_length,
+        train=True,
+        sampler=sampler,
+    )
+
+    def next_batch():
+        return next(train_batches)
+
+    next_rollout = None
+    # Sampler state after the batches trained on so far, without any prefetched one
+    trained_sampler_state = sampler.state_dict()
+
+    def fresh_rollout():
+        nonlocal next_rollout, trained_sampler_state
+        current_rollout = finalize(next_rollout or rollout(next_batch()))
+        trained_sampler_state = sampler.state_dict()
+        next_rollout = None
+        if args.pipeline_rollouts and it + args.replay_passes <= args.iters:
+            # Sample the next rollout before this update, then score it while the update runs
+            next_rollout = rollout(next_batch())
+        return current_rollout
 
     start = time.perf_counter()
     pbar = tqdm(range(1, args.iters + 1), desc="Training", disable=rank != 0)
     for it in pbar:
-        batch = next(iterate_batches(
-            dataset=train_dataset,
-            batch_size=args.batch_size,
-            max_seq_length=args.max_seq_length,
-            train=True,
-        ))
-
         if it == 1 or it % args.steps_per_eval == 0 or it == args.iters:
             stop = time.perf_counter()
             val_loss, val_ntokens, val_metrics = evaluate_grpo(
@@ -734,6 +1517,8 @@ def train_grpo(
                 temperature=args.temperature,
                 iterate_batches=iterate_batches,
                 grpo_loss_type=args.grpo_loss_type,
+                rollout_slots=args.rollout_slots,
+                reward_engine=reward_engine,
             )
             val_time = time.perf_counter() - stop
             if rank == 0:
@@ -753,7 +1538,16 @@ def train_grpo(
 
             start = time.perf_counter()
 
-        lvalue, toks, metrics = step(batch)
+        if replay_buffer is None:
+            lvalue, toks, metrics = step(fresh_rollout())
+        else:
+            # Generate every replay_passes steps and train on the buffer in between
+            if (it - 1) % args.replay_passes == 0:
+                replay_buffer.add(fresh_rollout())
+            replay_rollout, age = replay_buffer.sample()
+            lvalue, toks, metrics = step(replay_rollout)
+            metrics["replay_buffer_size"] = len(replay_buffer)
+            metrics["replay_sample_age"] = age
         losses += lvalue
         n_tokens += toks
         steps += 1
@@ -761,7 +1555,7 @@ def train_grpo(
         for k, v in metrics.items():
             accumulated_metrics[k] += v
 
-        mx.eval(state, losses, n_tokens)
+        mx.eval(compile_state, losses, n_tokens)
 
         if it % args.steps_per_report == 0 or it == args.iters:
             stop = time.perf_counter()
@@ -826,12 +1620,20 @@ def train_grpo(
                 Path(args.adapter_file).parent / f"{it:07d}_adapters.safetensors"
             )
             mx.save_safetensors(str(checkpoint), adapter_weights)
+            save_sampler_state(sampler, args.adapter_file, checkpoint, trained_sampler_state)
             tqdm.write(
                 f"\n"
                 f"Iter {it}: Saved adapter weights to "
                 f"{args.adapter_file} and {checkpoint}."
             )
 
+    if reward_executor is not None:
+        reward_executor.shutdown()
+    reward_engine.shutdown()
+    if reward_cache is not None:
+        reward_cache.close()
+
     adapter_weights = dict(tree_flatten(model.trainable_parameters()))
     mx.save_safetensors(str(args.adapter_file), adapter_weights)
+    save_sampler_state(sampler, args.adapter_file, state=trained_sampler_state)
     tqdm.write(f"Saved final weights to {args.adapter_file}.")
@@ -0,0 +1,135 @@
+from typing import Optional
+
+import mlx.core as mx
+import mlx.nn as nn
+
+from ..utils import AdapterDisabledModel, disable_adapters
+
+# Positions (over all rows of the batch) whose logits are materialized at once
+CHUNK_TOKENS = 256
+
+
+def output_head(model: nn.Module):
+    """
+    The output projection of an mlx-lm causal LM.
+
+    Supports models that compute ``lm_head(model.model(inputs))``, or the
+    tied-embedding equivalent. Models that scale or soft-cap their logits,
+    or have any other layout, return ``None``.
+
+    Returns:
+        Optional[Tuple[nn.Module, Callable]]: The module holding the head's
+        weights and the function mapping hidden states to logits.
+    """
+    args = getattr(model, "args", None)
+    inner = getattr(model, "model", None)
+    if args is None or not isinstance(inner, nn.Module):
+        return None
+    if getattr(args, "final_logit_softcapping", None) or getattr(args, "logit_scale", None):
+        return None
+    if getattr(args, "tie_word_embeddings", False):
+        if "embed_tokens" not in inner:
+            return None
+        return inner.embed_tokens, inner.embed_tokens.as_linear
+    if "lm_head" not in model:
+        return None
+    return model.lm_head, model.lm_head
+
+
+def _logprobs(logits, targets, logits_sum):
+    logits = logits.astype(mx.float32)
+    if targets is None:
+        # Greedy tokens are indices, not something to differentiate through
+        targets = mx.stop_gradient(mx.argmax(logits, axis=-1))
+    target_logits = mx.take_along_axis(logits, targets[..., None], axis=-1).squeeze(-1)
+    logps = target_logits - mx.logsumexp(logits, axis=-1)
+    return logps, targets, logits.sum(axis=-1) if logits_sum else None
+
+
+def token_logprobs(
+    model,
+    inputs: mx.array,
+    targets: Optional[mx.array] = None,
+    mask: Optional[mx.array] = None,
+    offset: int = 0,
+    chunk_tokens: int = CHUNK_TOKENS,
+    logits_sum: bool = False,
+):
+    """
+    Log-probabilities of ``targets`` under the logits of ``model(inputs)`` at
+    positions ``offset`` to ``offset + T``, without holding the full
+    ``(B, L, V)`` logits.
+
+    The hidden states of all rows are flattened and projected to logits in
+    chunks of ``chunk_tokens`` positions that are evaluated one at a time.
+    Every chunk is checkpointed, so the backward pass recomputes its logits
+    instead of keeping them. Models without a recognized output head (see
+    ``output_head``) are run whole.
+
+    Args:
+        model: The model, or an ``AdapterDisabledModel``.
+        inputs (mx.array): The ``(B, L)`` input tokens.
+        targets (mx.array, optional): The ``(B, T)`` tokens to score. If
+          ``None``, the greedy tokens at positions ``offset`` to ``L`` are
+          scored.
+        mask (mx.array, optional): Attention mask passed to the model.
+        offset (int): First position to score.
+        chunk_tokens (int): Positions, over all rows, per chunk.
+        logits_sum (bool): Also return the sum of the logits at every
+          scored position.
+
+    Returns:
+        Tuple[mx.array, mx.array, Optional[mx.array]]: The ``(B, T)``
+        log-probs, the scored tokens and the logits sums (``None`` unless
+        ``logits_sum``).
+    """
+    if isinstance(model, AdapterDisabledModel):
+        with disable_adapters(model.model):
+            return token_logprobs(
+                model.model, inputs, targets, mask, offset, chunk_tokens, logits_sum
+            )
+
+    end = inputs.shape[1] if targets is None else offset + targets.shape[1]
+    head = output_head(model)
+    if head is None:
+        logits = model(inputs) if mask is None else model(inputs, mask=mask)
+        return _logprobs(logits[:, offset:end], targets, logits_sum)
+
+    head_module, head_fn = head
+    hidden = model.model(inputs, mask=mask)[:, offset:end]
+
+    def chunk_logprobs(targets):
+        # Targets are closed over: token ids take no part in the backward pass
+        def fn(params, hidden):
+            head_module.update(params)
+            return _logprobs(head_fn(hidden), targets, logits_sum)
+
+        return mx.checkpoint(fn)
+
+    # Chunk over the flattened positions of all rows, so that chunks stay
+    # ``chunk_tokens`` wide however many rows there are
+    batch_size, length = hidden.shape[:2]
+    hidden = hidden.reshape(batch_size * length, -1)
+    if targets is not None:
+        targets = targets.reshape(-1)
+
+    params = head_module.trainable_parameters()
+    step = max(chunk_tokens, 1)
+    chunks = []
+    for start in range(0, batch_size * length, step):
+        chunk_targets = None if targets is None else targets[start : start + step]
+        chunk_hidden = hidden[start : start + step]
+        if chunks:
+            # A zero-weighted link to the previous chunk runs the chunks one
+            # after the other, in the forward and in the backward pass, so
+            # only one chunk's logits are alive at a time
+            link = 0 * chunks[-1][0].sum()
+            chunk_hidden = chunk_hidden + link.astype(chunk_hidden.dtype)
+        chunks.append(chunk_logprobs(chunk_targets)(params, chunk_hidden))
+
+    logps, targets, sums = zip(*chunks)
+    return (
+        mx.concatenate(logps).reshape(batch_size, length),
+        mx.concatenate(targets).reshape(batch_size, length),
+        mx.concatenate(sums).reshape(batch_size, length) if logits_sum else None,
+    )
@@ -4,7 +4,6 @@ from pathlib import Path
 import time
 from typing import Optional, List, Tuple, Dict, Any
 
-from mlx.nn.utils import average_gradients
 from mlx.utils import tree_flatten
 import mlx.core as mx
 import mlx.nn as nn
@@ -13,7 +12,14 @@ from tqdm import tqdm
 
 from mlx_lm.tuner.callbacks import TrainingCallback
 
-from .sft_trainer import SFTTrainingArgs, grad_checkpoint
+from .sft_trainer import (
+    GradientAccumulator,
+    SFTTrainingArgs,
+    bucket_length,
+    grad_checkpoint,
+    score_offset,
+)
+from .logprobs import token_logprobs
 
 
 @dataclass
@@ -27,15 +33,14 @@ class ORPOTrainingArgs(SFTTrainingArgs):
     )
 
 
-def get_logps(model, tokens, mask):
-    inputs = tokens[:, :-1]
-    targets = tokens[:, 1:]
-    logits = model(inputs)
-    log_probs = -nn.losses.cross_entropy(logits, targets, reduction="none")
-    mask = mask[:, :-1]
+def get_logps(model, tokens, mask, offset: int = 0):
+    log_probs, _, logits_sum = token_logprobs(
+        model, tokens[:, :-1], tokens[:, offset + 1 :], offset=offset, logits_sum=True
+    )
+    mask = mask[:, offset:-1]
     seq_lengths = mask.sum(-1)
     logp_seq_avg = (log_probs * mask).sum(-1) / seq_lengths
-    logits_mean = logits.sum() / mask.sum()
+    logits_mean = (logits_sum * mask).sum() / mask.sum()
     return logp_seq_avg, logits_mean
 
 
@@ -76,7 +81,7 @@ def orpo_loss(
     return mx.mean(loss), reward, num_tokens, metrics
 
 
-def iterate_orpo_batches(dataset, batch_size, max_seq_length, train=False):
+def iterate_orpo_batches(dataset, batch_size, max_seq_length, train=False, length_buckets=None):
     """Batch iterator for ORPO with preference scores"""
     idx = sorted(range(len(dataset)), key=lambda idx: len(dataset[idx]["chosen"]))
 
@@ -107,8 +112,8 @@ def iterate_orpo_batches(dataset, batch_size, max_seq_length, train=False):
             max_length = min(
                 max(max(chosen_lengths), max(rejected_lengths)), max_seq_length
             )
-            pad_to = 8
-            max_length_in_batch = pad_to * ((max_length + pad_to - 1) // pad_to)
+            # Pad to a length bucket so the compiled step sees few shapes
+            max_length_in_batch = min(bucket_length(max_length, length_buckets), max_seq_length)
 
             batch_size_per_device = batch_size // step
             chosen_arr = np.zeros(
@@ -128,16 +133,20 @@ def iterate_orpo_batches(dataset, batch_size, max_seq_length, train=False):
                 [x.get("preference_score", 1.0) for x in batch], np.float32
             )
 
+            # Log-probs line up with their inputs: the first completion token
+            # is scored at the last prompt position
+            mask_starts = [max(x.get("prompt_length", 0) - 1, 0) for x in batch]
+
             for j in range(batch_size_per_device):
                 chosen_length = min(chosen_lengths[j], max_length_in_batch)
                 rejected_length = min(rejected_lengths[j], max_length_in_batch)
 
                 chosen_arr[j, :chosen_length] = batch[j]["chosen"][:chosen_length]
-                chosen_masks[j, :chosen_length] = 1.0
+                chosen_masks[j, mask_starts[j] : chosen_length] = 1.0
                 rejected_arr[j, :rejected_length] = batch[j]["rejected"][
                     :rejected_length
                 ]
-                rejected_masks[j, :rejected_length] = 1.0
+                rejected_masks[j, mask_starts[j] : rejected_length] = 1.0
 
             yield (
                 mx.array(chosen_arr),
@@ -145,6 +154,7 @@ def iterate_orpo_batches(dataset, batch_size, max_seq_length, train=False):
                 mx.array(chosen_masks),
                 mx.array(rejected_masks),
                 mx.array(preference_scores),
+                score_offset(mask_starts, max_length_in_batch),
             )
 
         if not train:
@@ -168,10 +178,10 @@ def evaluate_orpo(
             max_seq_length=max_seq_length,
         ),
     ):
-        chosen, rejected, chosen_masks, rejected_masks, preference_scores = batch
+        chosen, rejected, chosen_masks, rejected_masks, preference_scores, offset = batch
 
-        chosen_logps, chosen_logits_mean = get_logps(model, chosen, chosen_masks)
-        rejected_logps, rejected_logits_mean = get_logps(model, rejected, rejected_masks)
+        chosen_logps, chosen_logits_mean = get_logps(model, chosen, chosen_masks, offset)
+        rejected_logps, rejected_logits_mean = get_logps(model, rejected, rejected_masks, offset)
 
         lvalue, reward, toks, metrics = orpo_loss(
             chosen_logps,
@@ -227,33 +237,15 @@ def train_orpo(
     if args.grad_checkpoint:
         grad_checkpoint(model.layers[0])
 
-    state = [model.state, optimizer.state]
-
-    def step(batch):
-        chosen, rejected, chosen_masks, rejected_masks, preference_scores = batch
-
-        chosen_logps, chosen_logits_mean = get_logps(model, chosen, chosen_masks)
-        rejected_logps, rejected_logits_mean = get_logps(model, rejected, rejected_masks)
-
-        (lvalue, reward, toks, metrics), grad = loss_value_and_grad(
-            chosen_logps,
-            chosen_logits_mean,
-            rejected_logps,
-            rejected_logits_mean,
-            chosen_masks,
-            rejected_masks,
-            preference_scores=preference_scores,
-        )
-
-        if (it + 1) % args.gradient_accumulation_steps == 0:
-            grad = average_gradients(grad)
-            optimizer.update(model, grad)
-
-        return (lvalue / args.gradient_accumulation_steps), reward, toks, metrics
+    accumulator = GradientAccumulator(model, optimizer, args.gradient_accumulation_steps)
+    state = [model.state, optimizer.state, mx.random.state, accumulator.state]
 
     def loss_wrapper(
-        chosen_logps, chosen_logits_mean, rejected_logps, rejected_logits_mean, chosen_masks, rejected_masks, preference_scores
+        model, chosen, rejected, chosen_masks, rejected_masks, preference_scores, offset
     ):
+        chosen_logps, chosen_logits_mean = get_logps(model, chosen, chosen_masks, offset)
+        rejected_logps, rejected_logits_mean = get_logps(model, rejected, rejected_masks, offset)
+
         return loss(
             chosen_logps=chosen_logps,
             chosen_logits_mean=chosen_logits_mean,
@@ -265,6 +257,12 @@ def train_orpo(
             beta=args.beta,
         )
 
+    @partial(mx.compile, inputs=state, outputs=state)
+    def step(batch, update):
+        (lvalue, reward, toks, metrics), grad = loss_value_and_grad(model, *batch)
+        accumulator.accumulate(grad, update)
+        return lvalue, reward, toks, metrics
+
     loss_value_and_grad = nn.value_and_grad(model, loss_wrapper)
 
     losses = 0
@@ -289,6 +287,7 @@ def train_orpo(
             batch_size=args.batch_size,
             max_seq_length=args.max_seq_length,
             train=True,
+            length_buckets=args.length_buckets,
         ))
 
         if it == 1 or it % args.steps_per_eval == 0 or it == args.iters:
@@ -328,7 +327,7 @@ def train_orpo(
             start = time.perf_counter()
 
         # Training step
-        lvalue, reward, toks, metrics = step(batch)
+        lvalue, reward, toks, metrics = step(batch, accumulator.advance())
         losses += lvalue
         rewards += reward
         n_tokens += toks
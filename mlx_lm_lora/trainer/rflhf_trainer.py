@@ -1,16 +1,17 @@
 from dataclasses import dataclass, field
 from pathlib import Path
 from tqdm import tqdm
+import math
 import time
 
-from mlx.nn.utils import average_gradients
 from mlx.utils import tree_flatten
 
 from mlx_lm.tuner.callbacks import TrainingCallback
 
-from .online_dpo_trainer import generate_for_online_dpo, iterate_online_dpo_batches, compute_score
-from .sft_trainer import SFTTrainingArgs, grad_checkpoint
+from .online_dpo_trainer import generate_for_online_dpo, iterate_online_dpo_batches, pad_sequences
+from .sft_trainer import GradientAccumulator, SFTTrainingArgs, grad_checkpoint
 from .judge import LLMPPOJudge
+from .logprobs import token_logprobs
 
 import mlx.core as mx
 import mlx.nn as nn
@@ -46,17 +47,12 @@ def compute_kl_penalty(logits_policy, logits_ref, masks):
 
 
 def rlhf_loss(
-    policy_logits: mx.array,
-    ref_logits: mx.array,
+    policy_log_probs: mx.array,
+    ref_log_probs: mx.array,
     rewards: mx.array,
     masks: mx.array,
     beta: float,
 ):
-    # Compute log probabilities for actual tokens
-    labels = mx.argmax(policy_logits, axis=-1)
-    policy_log_probs = -nn.losses.cross_entropy(policy_logits, labels, reduction='none')
-    ref_log_probs = -nn.losses.cross_entropy(ref_logits, labels, reduction='none')
-    
     # Compute KL divergence per token
     kl_div = policy_log_probs - ref_log_probs
     
@@ -84,11 +80,53 @@ def rlhf_loss(
     return loss, token_count, metrics
 
 
-def get_model_logits(model, tokens, masks):
-    inputs = tokens[:, :-1]
-    targets = tokens[:, 1:]
-    target_masks = masks[:, 1:]
-    return model(inputs), targets, target_masks
+def get_model_log_probs(model, tokens, masks, labels=None):
+    """
+    Log-probs of ``labels`` at every next-token position, or of the model's
+    greedy tokens if ``labels`` is ``None``.
+
+    Returns:
+        Tuple[mx.array, mx.array, mx.array]: The log-probs, the scored labels
+        and the target masks.
+    """
+    log_probs, labels, _ = token_logprobs(model, tokens[:, :-1], labels)
+    return log_probs, labels, masks[:, 1:]
+
+
+def get_policy_and_ref_log_probs(model, ref_model, tokens, masks):
+    """
+    Log-probs of the policy's greedy tokens under the policy and, without
+    gradient, under the reference model. Without a reference model, the
+    reference is uniform over the vocabulary (zero logits).
+
+    Returns:
+        Tuple[mx.array, mx.array, mx.array]: The policy and reference
+        log-probs and the target masks.
+    """
+    policy_log_probs, labels, target_masks = get_model_log_probs(model, tokens, masks)
+    if ref_model is None:
+        ref_log_probs = mx.full(policy_log_probs.shape, -math.log(model.args.vocab_size))
+    else:
+        ref_log_probs, _, _ = get_model_log_probs(ref_model, tokens, masks, labels)
+    return policy_log_probs, mx.stop_gradient(ref_log_probs), target_masks
+
+
+def pad_judged_completions(tokenizer, prompt_texts, completions, rewards):
+    """
+    Tokenize every judged completion with its prompt into one padded batch.
+
+    Returns:
+        Tuple[mx.array, mx.array, mx.array]: The tokens, their mask and the
+        reward of each sequence.
+    """
+    sequences = []
+    all_rewards = []
+    for prompt_text, completion_pair, reward_pair in zip(prompt_texts, completions, rewards):
+        for completion, reward in zip(completion_pair, reward_pair):
+            sequences.append(tokenizer.encode(prompt_text + completion))
+            all_rewards.append(reward)
+    tokens, masks = pad_sequences(sequences)
+    return tokens, masks, mx.array(all_rewards)
 
 
 def evaluate_rlhf(
@@ -129,50 +167,18 @@ def evaluate_rlhf(
         rewards = judger.judge(prompt_texts, completions=completions)
         
         # Process completions into tokens and masks
-        all_tokens = []
-        all_masks = []
-        all_rewards = []
-        
-        for i, (prompt_text, completion_pair, reward_pair) in enumerate(zip(prompt_texts, completions, rewards)):
-            for j, (completion, reward) in enumerate(zip(completion_pair, reward_pair)):
-                full_text = prompt_text + completion
-                tokens = mx.array(tokenizer.encode(full_text))
-                mask = mx.ones(len(tokens))
-                
-                all_tokens.append(tokens)
-                all_masks.append(mask)
-                all_rewards.append(reward)
-        
-        # Pad sequences to same length
-        max_len = max(len(tokens) for tokens in all_tokens)
-        padded_tokens = []
-        padded_masks = []
-        
-        for tokens, mask in zip(all_tokens, all_masks):
-            pad_len = max_len - len(tokens)
-            if pad_len > 0:
-                padded_tokens.append(mx.concatenate([tokens, mx.zeros(pad_len, dtype=tokens.dtype)]))
-                padded_masks.append(mx.concatenate([mask, mx.zeros(pad_len)]))
-            else:
-                padded_tokens.append(tokens)
-                padded_masks.append(mask)
-        
-        batch_tokens = mx.stack(padded_tokens)
-        batch_masks = mx.stack(padded_masks)
-        batch_rewards = mx.array(all_rewards)
-        
-        # Get model logits
-        policy_logits, targets, target_masks = get_model_logits(model, batch_tokens, batch_masks)
-        
-        if ref_model is not None:
-            ref_logits, _, _ = get_model_logits(ref_model, batch_tokens, batch_masks)
-        else:
-            ref_logits = mx.zeros_like(policy_logits)
-        
+        batch_tokens, batch_masks, batch_rewards = pad_judged_completions(
+            tokenizer, prompt_texts, completions, rewards
+        )
+
+        policy_log_probs, ref_log_probs, target_masks = get_policy_and_ref_log_probs(
+            model, ref_model, batch_tokens, batch_masks
+        )
+
         # Compute loss
         loss_value, toks, metrics = loss_fn(
-            policy_logits=policy_logits,
-            ref_logits=ref_logits,
+            policy_log_probs=policy_log_probs,
+            ref_log_probs=ref_log_probs,
             rewards=batch_rewards,
             masks=target_masks,
             beta=beta,
@@ -225,7 +231,8 @@ def train_rlhf(
     if args.grad_checkpoint:
         grad_checkpoint(model.layers[0])
 
-    state = [model.state, optimizer.state]
+    accumulator = GradientAccumulator(model, optimizer, args.gradient_accumulation_steps)
+    state = [model.state, optimizer.state, accumulator.state]
 
     def step(batch):
         prompts, prompt_texts = batch
@@ -238,63 +245,28 @@ def train_rlhf(
         rewards = judger.judge(prompt_texts, completions=completions)
         
         # Process completions into tokens and masks
-        all_tokens = []
-        all_masks = []
-        all_rewards = []
-        
-        for i, (prompt_text, completion_pair, reward_pair) in enumerate(zip(prompt_texts, completions, rewards)):
-            for j, (completion, reward) in enumerate(zip(completion_pair, reward_pair)):
-                full_text = prompt_text + completion
-                tokens = mx.array(tokenizer.encode(full_text))
-                mask = mx.ones(len(tokens))
-                
-                all_tokens.append(tokens)
-                all_masks.append(mask)
-                all_rewards.append(reward)
-        
-        # Pad sequences to same length
-        max_len = max(len(tokens) for tokens in all_tokens)
-        padded_tokens = []
-        padded_masks = []
-        
-        for tokens, mask in zip(all_tokens, all_masks):
-            pad_len = max_len - len(tokens)
-            if pad_len > 0:
-                padded_tokens.append(mx.concatenate([tokens, mx.zeros(pad_len, dtype=tokens.dtype)]))
-                padded_masks.append(mx.concatenate([mask, mx.zeros(pad_len)]))
-            else:
-                padded_tokens.append(tokens)
-                padded_masks.append(mask)
-        
-        batch_tokens = mx.stack(padded_tokens)
-        batch_masks = mx.stack(padded_masks)
-        batch_rewards = mx.array(all_rewards)
-        
-        # Get model logits
-        policy_logits, targets, target_masks = get_model_logits(model, batch_tokens, batch_masks)
-        
-        if ref_model is not None:
-            ref_logits, _, _ = get_model_logits(ref_model, batch_tokens, batch_masks)
-        else:
-            ref_logits = mx.zeros_like(policy_logits)
-        
-        # Compute loss and gradients
+        batch_tokens, batch_masks, batch_rewards = pad_judged_completions(
+            tokenizer, prompt_texts, completions, rewards
+        )
+
+        # Compute loss and gradients, with the policy pass inside the differentiated function
         (lvalue, toks, metrics), grad = loss_value_and_grad(
-            policy_logits, ref_logits, batch_rewards, target_masks
+            batch_tokens, batch_masks, batch_rewards
         )
         
-        if (it + 1) % args.gradient_accumulation_steps == 0:
-            grad = average_gradients(grad)
-            optimizer.update(model, grad)
+        accumulator.accumulate(grad, accumulator.advance())
 
-        return (lvalue / args.gradient_accumulation_steps), [], toks, metrics
+        return lvalue, [], toks, metrics
 
-    def loss_wrapper(policy_logits, ref_logits, rewards, masks):
+    def loss_wrapper(tokens, masks, rewards):
+        policy_log_probs, ref_log_probs, target_masks = get_policy_and_ref_log_probs(
+            model, ref_model, tokens, masks
+        )
         return loss_fn(
-            policy_logits=policy_logits,
-            ref_logits=ref_logits,
+            policy_log_probs=policy_log_probs,
+            ref_log_probs=ref_log_probs,
             rewards=rewards,
-            masks=masks,
+            masks=target_masks,
             beta=args.beta,
         )
 
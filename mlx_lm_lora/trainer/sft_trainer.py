@@ -1,10 +1,12 @@
 from dataclasses import dataclass, field
 from functools import partial
 from pathlib import Path
+from typing import List, Optional
+import json
 import time
 
 from mlx.nn.utils import average_gradients
-from mlx.utils import tree_flatten
+from mlx.utils import tree_flatten, tree_unflatten
 import mlx.core as mx
 import mlx.nn as nn
 import numpy as np
@@ -13,6 +15,7 @@ from tqdm import tqdm
 from mlx_lm.tuner.callbacks import TrainingCallback
 
 from .datasets import CacheDataset
+from .logprobs import token_logprobs
 
 
 def grad_checkpoint(layer):
@@ -63,20 +66,222 @@ class SFTTrainingArgs:
         default=False,
         metadata={"help": "Use gradient checkpointing to reduce memory use."},
     )
+    sampler_state_file: Optional[str] = field(
+        default=None,
+        metadata={"help": "Saved batch sampler state to resume the training data order from."},
+    )
+    length_buckets: Optional[List[int]] = field(
+        default=None,
+        metadata={
+            "help": "Sequence lengths that batches are padded up to, so compiled steps see a small set of "
+                "shapes. Longer batches are padded to a multiple of 32. If `None`, every batch is "
+                "padded to a multiple of 32."
+        },
+    )
+
+
+class BatchSampler:
+    """
+    Walks fixed batches of dataset indices epoch by epoch.
+
+    The batches are built once by the batch iterator. Every epoch visits each
+    batch once, in an order drawn from ``seed`` and the epoch number, and the
+    position within the epoch is tracked so that a run can be checkpointed
+    and resumed where it left off.
+    """
+
+    def __init__(self, shuffle: bool = True, seed: Optional[int] = None):
+        self.shuffle = shuffle
+        self.seed = int(np.random.randint(2**31)) if seed is None else seed
+        self.epoch = 0
+        self.position = 0
+        self.batch_indices = None
+        self._num_batches = None
+
+    def __len__(self):
+        return len(self.batch_indices)
+
+    def set_batches(self, batch_indices: List[List[int]]):
+        if self._num_batches is not None and self._num_batches != len(batch_indices):
+            raise ValueError(
+                f"The sampler state covers {self._num_batches} batches but the "
+                f"dataset has {len(batch_indices)}."
+            )
+        self.batch_indices = batch_indices
+        self._num_batches = len(batch_indices)
+
+    def __iter__(self):
+        if self.shuffle:
+            order = np.random.RandomState(self.seed + self.epoch).permutation(len(self))
+        else:
+            order = np.arange(len(self))
+        while self.position < len(order):
+            self.position += 1
+            yield self.batch_indices[order[self.position - 1]]
+        self.epoch += 1
+        self.position = 0
+
+    def state_dict(self):
+        return {
+            "seed": self.seed,
+            "epoch": self.epoch,
+            "position": self.position,
+            "num_batches": self._num_batches,
+        }
+
+    def load_state_dict(self, state):
+        self.seed = state["seed"]
+        self.epoch = state["epoch"]
+        self.position = state["position"]
+        self._num_batches = state["num_batches"]
+
+    def save(self, path, state=None):
+        with open(path, "w") as f:
+            json.dump(self.state_dict() if state is None else state, f)
+
+    def load(self, path):
+        with open(path) as f:
+            self.load_state_dict(json.load(f))
+
+
+def bucket_length(
+    length: int, length_buckets: Optional[List[int]] = None, pad_to: int = 32
+) -> int:
+    """
+    Padded length of a batch whose longest sequence has ``length`` tokens.
+
+    The length is rounded up to the smallest of ``length_buckets`` that fits
+    it, or to a multiple of ``pad_to`` when there are no buckets or it is
+    longer than all of them.
+    """
+    for bucket in sorted(length_buckets or []):
+        if length <= bucket:
+            return bucket
+    return pad_to * ((length + pad_to - 1) // pad_to)
+
+
+def score_offset(mask_starts: List[int], length: int, pad_to: int = 32) -> int:
+    """
+    First position that needs scoring in a padded batch of ``length`` tokens
+    whose rows are masked before ``mask_starts``.
+
+    The offset is rounded down to a multiple of ``pad_to`` so that compiled
+    steps see few distinct offsets, and kept below ``length - 1``.
+    """
+    return max(min(min(mask_starts), length - 2), 0) // pad_to * pad_to
+
+
+class GradientAccumulator:
+    """
+    Sums gradients over ``steps`` micro-batches and applies their average in
+    a single optimizer update.
+
+    The running sum lives in a buffer allocated once, up front, with the
+    shapes of the trainable parameters. Compiled steps must list ``state``
+    among their inputs and outputs, and get the ``update`` flag from
+    ``advance`` on the host so that it is not baked into the trace.
+
+    A step may itself be split into several chunks whose losses are
+    normalized over the whole step. Their gradients are summed with
+    ``update=False`` for all but the last chunk, and ``advance`` is called
+    once per step.
+
+    Args:
+        model (nn.Module): The model being trained.
+        optimizer: The optimizer that applies the averaged gradients.
+        steps (int): Number of micro-batches per optimizer update.
+        chunked (bool): Whether steps are split into chunks, which needs the
+          buffer even when ``steps`` is 1.
+    """
+
+    def __init__(self, model: nn.Module, optimizer, steps: int = 1, chunked: bool = False):
+        if steps < 1:
+            raise ValueError(f"gradient_accumulation_steps must be at least 1, got {steps}.")
+        self.model = model
+        self.optimizer = optimizer
+        self.steps = steps
+        self.micro_step = 0
+        # With a single, unchunked micro-batch per update there is nothing to buffer
+        self.grad = {}
+        if steps > 1 or chunked:
+            self.grad = {
+                k: mx.zeros_like(v) for k, v in tree_flatten(model.trainable_parameters())
+            }
+
+    @property
+    def state(self):
+        return self.grad
+
+    def advance(self) -> bool:
+        """
+        Count one micro-batch and tell whether it completes an update.
+        """
+        self.micro_step += 1
+        return self.micro_step % self.steps == 0
+
+    def accumulate(self, grad, update: bool):
+        """
+        Add ``grad`` to the buffer and, if ``update``, average the buffer
+        across micro-batches and workers, apply it and reset the buffer.
+        """
+        if not self.grad:
+            self.optimizer.update(self.model, average_gradients(grad))
+            return
+
+        flat_grad = tree_flatten(grad)
+        if not update:
+            for k, g in flat_grad:
+                self.grad[k] = self.grad[k] + g
+            return
+
+        grad = tree_unflatten(
+            [(k, (self.grad[k] + g) / self.steps) for k, g in flat_grad]
+        )
+        self.optimizer.update(self.model, average_gradients(grad))
+        for k, g in self.grad.items():
+            self.grad[k] = mx.zeros_like(g)
+
+
+def sampler_state_path(adapter_file) -> Path:
+    """
+    Where the sampler state belonging to an adapter weights file is stored,
+    e.g. ``0000100_sampler_state.json`` for ``0000100_adapters.safetensors``.
+    """
+    adapter_file = Path(adapter_file)
+    if adapter_file.name.endswith("adapters.safetensors"):
+        name = adapter_file.name[: -len("adapters.safetensors")] + "sampler_state.json"
+    else:
+        name = adapter_file.stem + "_sampler_state.json"
+    return adapter_file.with_name(name)
+
+
+def save_sampler_state(
+    sampler: BatchSampler, adapter_file, checkpoint=None, state: Optional[dict] = None
+):
+    """
+    Save the sampler state next to the adapter weights (and the numbered
+    checkpoint, if given) so that resuming from them continues the data order.
+
+    ``state`` is saved instead of the sampler's current state when given, e.g.
+    when batches have been drawn ahead of the ones trained on.
+    """
+    for path in [adapter_file, checkpoint]:
+        if path is not None:
+            sampler.save(sampler_state_path(path), state)
 
 
 def default_loss(model, batch, lengths):
     inputs = batch[:, :-1]
     targets = batch[:, 1:]
 
-    logits = model(inputs)
+    logps, _, _ = token_logprobs(model, inputs, targets)
 
     steps = mx.arange(1, targets.shape[1] + 1)
     mask = mx.logical_and(steps >= lengths[:, 0:1], steps <= lengths[:, 1:])
 
-    loss = nn.losses.cross_entropy(logits, targets) * mask
+    loss = -logps * mask
     ntoks = mask.sum()
-    loss = loss.astype(mx.float32).sum() / ntoks
+    loss = loss.sum() / ntoks
     return loss, ntoks
 
 
@@ -85,6 +290,8 @@ def iterate_batches(
     batch_size,
     max_seq_length,
     train=False,
+    sampler: Optional[BatchSampler] = None,
+    length_buckets: Optional[List[int]] = None,
 ):
     if isinstance(dataset, CacheDataset):
         len_fn = lambda idx: dataset.itemlen(idx)
@@ -105,19 +312,20 @@ def iterate_batches(
         idx[i : i + batch_size : step]
         for i in range(0, len(idx) - batch_size + 1, batch_size)
     ]
+    if sampler is None:
+        sampler = BatchSampler()
+    sampler.set_batches(batch_idx)
 
     while True:
-        indices = np.random.permutation(len(batch_idx))
-        for i in indices:
-            batch = [dataset[j] for j in batch_idx[i]]
+        for batch_indices in sampler:
+            batch = [dataset[j] for j in batch_indices]
             if len(batch[0]) == 2:
                 batch, offsets = zip(*batch)
             else:
                 offsets = [0] * len(batch)
             lengths = [len(x) for x in batch]
 
-            pad_to = 32
-            max_length_in_batch = 1 + pad_to * ((max(lengths) + pad_to - 1) // pad_to)
+            max_length_in_batch = 1 + bucket_length(max(lengths), length_buckets)
             max_length_in_batch = min(max_length_in_batch, max_seq_length)
 
             batch_arr = np.zeros((batch_size // step, max_length_in_batch), np.int32)
@@ -190,18 +398,15 @@ def train_sft(
     if args.grad_checkpoint:
         grad_checkpoint(model.layers[0])
 
-    state = [model.state, optimizer.state, mx.random.state]
+    accumulator = GradientAccumulator(model, optimizer, args.gradient_accumulation_steps)
+    state = [model.state, optimizer.state, mx.random.state, accumulator.state]
 
     @partial(mx.compile, inputs=state, outputs=state)
-    def step(batch):
+    def step(batch, update):
         # Forward and backward pass
         (lvalue, toks), grad = loss_value_and_grad(model, *batch)
-
-        if (it + 1) % args.gradient_accumulation_steps == 0:
-            grad = average_gradients(grad)
-            optimizer.update(model, grad)
-
-        return (lvalue / args.gradient_accumulation_steps), toks
+        accumulator.accumulate(grad, update)
+        return lvalue, toks
 
     loss_value_and_grad = nn.value_and_grad(model, loss)
 
@@ -211,15 +416,24 @@ def train_sft(
     steps = 0
     trained_tokens = 0
     train_time = 0
+
+    # One persistent iterator: the dataset is sorted once and epochs are walked in order
+    sampler = BatchSampler()
+    if args.sampler_state_file is not None:
+        sampler.load(args.sampler_state_file)
+    train_batches = iterate_batches(
+        dataset=train_dataset,
+        batch_size=args.batch_size,
+        max_seq_length=args.max_seq_length,
+        train=True,
+        sampler=sampler,
+        length_buckets=args.length_buckets,
+    )
+
     # Main training loop
     pbar = tqdm(range(1, args.iters + 1), desc="Training", disable=rank != 0)
     for it in pbar:
-        batch = next(iterate_batches(
-            dataset=train_dataset,
-            batch_size=args.batch_size,
-            max_seq_length=args.max_seq_length,
-            train=True,
-        ))
+        batch = next(train_batches)
         tic = time.perf_counter()
         if it == 1 or it % args.steps_per_eval == 0 or it == args.iters:
             tic = time.perf_counter()
@@ -251,7 +465,7 @@ def train_sft(
 
             tic = time.perf_counter()
 
-        lvalue, toks = step(batch)
+        lvalue, toks = step(batch, accumulator.advance())
         losses += lvalue
         n_tokens += toks
         steps += 1
@@ -306,6 +520,7 @@ def train_sft(
                 Path(args.adapter_file).parent / f"{it:07d}_adapters.safetensors"
             )
             mx.save_safetensors(str(checkpoint), adapter_weights)
+            save_sampler_state(sampler, args.adapter_file, checkpoint)
             tqdm.write(
                 f"\n"
                 f"Iter {it}: Saved adapter weights to "
@@ -315,4 +530,5 @@ def train_sft(
     if rank == 0:
         adapter_weights = dict(tree_flatten(model.trainable_parameters()))
         mx.save_safetensors(str(args.adapter_file), adapter_weights)
+        save_sampler_state(sampler, args.adapter_file)
         tqdm.write(f"Saved final weights to {args.adapter_file}.")
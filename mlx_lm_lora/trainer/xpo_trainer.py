@@ -3,15 +3,18 @@ from pathlib import Path
 from tqdm import tqdm
 import time
 
-from mlx.nn.utils import average_gradients
 from mlx.utils import tree_flatten
 
 from mlx_lm.tuner.callbacks import TrainingCallback
 
-from .online_dpo_trainer import OnlineDPOTrainingArgs, generate_for_online_dpo, compute_score
+from .online_dpo_trainer import (
+    OnlineDPOTrainingArgs,
+    generate_for_online_dpo,
+    get_sequence_scores,
+    pad_sequences,
+)
 from .judge import LLMPairwiseJudge, HumanPairwiseJudge
-from .dpo_trainer import get_token_scores
-from .sft_trainer import grad_checkpoint
+from .sft_trainer import GradientAccumulator, grad_checkpoint
 
 import mlx.core as mx
 import mlx.nn as nn
@@ -198,65 +201,22 @@ def evaluate_xpo(
                 chosen.append(prompt_text + completion_pair[1])
                 rejected.append(prompt_text + completion_pair[0])
         
-        chosen_tokens = [mx.array(tokenizer.encode(text)) for text in chosen]
-        rejected_tokens = [mx.array(tokenizer.encode(text)) for text in rejected]
-        
-        chosen_masks = [mx.ones(len(tokens)) for tokens in chosen_tokens]
-        rejected_masks = [mx.ones(len(tokens)) for tokens in rejected_tokens]
-        
-        # Fix the get_token_scores calls - convert to proper batch format
-        policy_chosen_scores = []
-        policy_rejected_scores = []
-        
-        for tokens, mask in zip(chosen_tokens, chosen_masks):
-            batch_tokens = tokens.reshape(1, -1)  # Shape: (1, seq_len)
-            batch_mask = mask.reshape(1, -1)      # Shape: (1, seq_len)
-            score = get_token_scores(model, batch_tokens, batch_mask)
-            policy_chosen_scores.append(score)
-            
-        for tokens, mask in zip(rejected_tokens, rejected_masks):
-            batch_tokens = tokens.reshape(1, -1)
-            batch_mask = mask.reshape(1, -1)
-            score = get_token_scores(model, batch_tokens, batch_mask)
-            policy_rejected_scores.append(score)
-        
-        policy_chosen_score = mx.array([compute_score(score, mask, loss_type) for score, mask in zip(policy_chosen_scores, chosen_masks)])
-        policy_rejected_score = mx.array([compute_score(score, mask, loss_type) for score, mask in zip(policy_rejected_scores, rejected_masks)])
-        
-        if ref_model is None:
-            reference_chosen_logprobs = mx.zeros_like(policy_chosen_score)
-            reference_rejected_logprobs = mx.zeros_like(policy_rejected_score)
-        else:
-            ref_chosen_scores = []
-            ref_rejected_scores = []
-            
-            for tokens, mask in zip(chosen_tokens, chosen_masks):
-                batch_tokens = tokens.reshape(1, -1)
-                batch_mask = mask.reshape(1, -1)
-                score = mx.stop_gradient(get_token_scores(ref_model, batch_tokens, batch_mask))
-                ref_chosen_scores.append(score)
-                
-            for tokens, mask in zip(rejected_tokens, rejected_masks):
-                batch_tokens = tokens.reshape(1, -1)
-                batch_mask = mask.reshape(1, -1)
-                score = mx.stop_gradient(get_token_scores(ref_model, batch_tokens, batch_mask))
-                ref_rejected_scores.append(score)
-                
-            reference_chosen_logprobs = mx.array([compute_score(score, mask, loss_type) for score, mask in zip(ref_chosen_scores, chosen_masks)])
-            reference_rejected_logprobs = mx.array([compute_score(score, mask, loss_type) for score, mask in zip(ref_rejected_scores, rejected_masks)])
-        
-        # Convert masks to token counts
-        chosen_mask_counts = mx.array([mask.sum() for mask in chosen_masks])
-        rejected_mask_counts = mx.array([mask.sum() for mask in rejected_masks])
-        
+        chosen_tokens, chosen_masks = pad_sequences([tokenizer.encode(text) for text in chosen])
+        rejected_tokens, rejected_masks = pad_sequences([tokenizer.encode(text) for text in rejected])
+
+        policy_chosen_score = get_sequence_scores(model, chosen_tokens, chosen_masks, loss_type)
+        policy_rejected_score = get_sequence_scores(model, rejected_tokens, rejected_masks, loss_type)
+        reference_chosen_logprobs = get_sequence_scores(ref_model, chosen_tokens, chosen_masks, loss_type)
+        reference_rejected_logprobs = get_sequence_scores(ref_model, rejected_tokens, rejected_masks, loss_type)
+
         # Compute loss
         loss_value, reward, toks, metrics = loss_fn(
             policy_chosen_score=policy_chosen_score,
             policy_rejected_score=policy_rejected_score,
             reference_chosen_score=reference_chosen_logprobs,
             reference_rejected_score=reference_rejected_logprobs,
-            chosen_masks=chosen_mask_counts,
-            rejected_masks=rejected_mask_counts,
+            chosen_masks=chosen_masks,
+            rejected_masks=rejected_masks,
             loss_type=loss_type,
             beta=beta,
             delta=delta,
@@ -313,7 +273,8 @@ def train_xpo(
     if args.grad_checkpoint:
         grad_checkpoint(model.layers[0])
 
-    state = [model.state, optimizer.state]
+    accumulator = GradientAccumulator(model, optimizer, args.gradient_accumulation_steps)
+    state = [model.state, optimizer.state, accumulator.state]
 
     def step(batch, current_alpha):
         prompts, prompt_texts = batch
@@ -341,76 +302,33 @@ def train_xpo(
                 rejected.append(prompt_text + completion_pair[0])
         
         # Tokenize chosen and rejected
-        chosen_tokens = [mx.array(tokenizer.encode(text)) for text in chosen]
-        rejected_tokens = [mx.array(tokenizer.encode(text)) for text in rejected]
-        
-        # Create masks
-        chosen_masks = [mx.ones(len(tokens)) for tokens in chosen_tokens]
-        rejected_masks = [mx.ones(len(tokens)) for tokens in rejected_tokens]
-        
-        # Get policy scores
-        policy_chosen_scores = []
-        policy_rejected_scores = []
-        
-        for tokens, mask in zip(chosen_tokens, chosen_masks):
-            batch_tokens = tokens.reshape(1, -1)
-            batch_mask = mask.reshape(1, -1)
-            score = get_token_scores(model, batch_tokens, batch_mask)
-            policy_chosen_scores.append(score)
-            
-        for tokens, mask in zip(rejected_tokens, rejected_masks):
-            batch_tokens = tokens.reshape(1, -1)
-            batch_mask = mask.reshape(1, -1)
-            score = get_token_scores(model, batch_tokens, batch_mask)
-            policy_rejected_scores.append(score)
-        
-        policy_chosen_score = mx.array([compute_score(score, mask, args.loss_type) for score, mask in zip(policy_chosen_scores, chosen_masks)])
-        policy_rejected_score = mx.array([compute_score(score, mask, args.loss_type) for score, mask in zip(policy_rejected_scores, rejected_masks)])
-        
+        chosen_tokens, chosen_masks = pad_sequences([tokenizer.encode(text) for text in chosen])
+        rejected_tokens, rejected_masks = pad_sequences([tokenizer.encode(text) for text in rejected])
+
         # Get reference scores
-        if ref_model is None:
-            reference_chosen_logprobs = mx.zeros_like(policy_chosen_score)
-            reference_rejected_logprobs = mx.zeros_like(policy_rejected_score)
-        else:
-            ref_chosen_scores = []
-            ref_rejected_scores = []
-            
-            for tokens, mask in zip(chosen_tokens, chosen_masks):
-                batch_tokens = tokens.reshape(1, -1)
-                batch_mask = mask.reshape(1, -1)
-                score = mx.stop_gradient(get_token_scores(ref_model, batch_tokens, batch_mask))
-                ref_chosen_scores.append(score)
-                
-            for tokens, mask in zip(rejected_tokens, rejected_masks):
-                batch_tokens = tokens.reshape(1, -1)
-                batch_mask = mask.reshape(1, -1)
-                score = mx.stop_gradient(get_token_scores(ref_model, batch_tokens, batch_mask))
-                ref_rejected_scores.append(score)
-                
-            reference_chosen_logprobs = mx.array([compute_score(score, mask, args.loss_type) for score, mask in zip(ref_chosen_scores, chosen_masks)])
-            reference_rejected_logprobs = mx.array([compute_score(score, mask, args.loss_type) for score, mask in zip(ref_rejected_scores, rejected_masks)])
-        
-        # Convert masks to token counts
-        chosen_mask_counts = mx.array([mask.sum() for mask in chosen_masks])
-        rejected_mask_counts = mx.array([mask.sum() for mask in rejected_masks])
-        
-        # Compute loss and gradients
+        reference_chosen_score = mx.stop_gradient(
+            get_sequence_scores(ref_model, chosen_tokens, chosen_masks, args.loss_type)
+        )
+        reference_rejected_score = mx.stop_gradient(
+            get_sequence_scores(ref_model, rejected_tokens, rejected_masks, args.loss_type)
+        )
+
+        # Compute loss and gradients, with the policy scores inside the differentiated function
         (lvalue, reward, toks, metrics), grad = loss_value_and_grad(
-            policy_chosen_score, policy_rejected_score, 
-            reference_chosen_logprobs, reference_rejected_logprobs, 
-            chosen_mask_counts, rejected_mask_counts, current_alpha
+            chosen_tokens, rejected_tokens,
+            chosen_masks, rejected_masks,
+            reference_chosen_score, reference_rejected_score,
+            current_alpha,
         )
-        
-        if (it + 1) % args.gradient_accumulation_steps == 0:
-            grad = average_gradients(grad)
-            optimizer.update(model, grad)
 
-        return (lvalue / args.gradient_accumulation_steps), reward, toks, metrics
+        accumulator.accumulate(grad, accumulator.advance())
 
-    def loss_wrapper(policy_chosen_score, policy_rejected_score, reference_chosen_score, reference_rejected_score, chosen_masks, rejected_masks, alpha):
+        return lvalue, reward, toks, metrics
+
+    def loss_wrapper(chosen_tokens, rejected_tokens, chosen_masks, rejected_masks, reference_chosen_score, reference_rejected_score, alpha):
         return loss_fn(
-            policy_chosen_score=policy_chosen_score,
-            policy_rejected_score=policy_rejected_score,
+            policy_chosen_score=get_sequence_scores(model, chosen_tokens, chosen_masks, args.loss_type),
+            policy_rejected_score=get_sequence_scores(model, rejected_tokens, rejected_masks, args.loss_type),
             reference_chosen_score=reference_chosen_score,
             reference_rejected_score=reference_rejected_score,
             chosen_masks=chosen_masks,
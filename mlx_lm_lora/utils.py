@@ -1,9 +1,12 @@
 from typing import Optional, Tuple, Any
+from contextlib import contextmanager
 from pathlib import Path
 
 from mlx.utils import tree_flatten, tree_unflatten
 
 from mlx_lm.gguf import convert_to_gguf
+from mlx_lm.tuner.dora import DoRAEmbedding, DoRALinear
+from mlx_lm.tuner.lora import LoRAEmbedding, LoRALinear, LoRASwitchLinear
 from mlx_lm.tuner.utils import dequantize, load_adapters, linear_to_lora_layers
 from mlx_lm.utils import (
     save_model,
@@ -23,6 +26,55 @@ def calculate_iters(train_set, batch_size, epochs) -> int:
     return iters
 
 
+ADAPTER_LAYERS = (LoRALinear, LoRASwitchLinear, LoRAEmbedding, DoRALinear, DoRAEmbedding)
+
+
+@contextmanager
+def disable_adapters(model: nn.Module):
+    """
+    Temporarily swap every LoRA/DoRA layer of the model for the base layer it
+    wraps, so the model computes the output of the original weights.
+    """
+    adapters = [
+        (n, m) for n, m in model.named_modules() if isinstance(m, ADAPTER_LAYERS)
+    ]
+    base_layers = [
+        (n, m.embedding if isinstance(m, (LoRAEmbedding, DoRAEmbedding)) else m.linear)
+        for n, m in adapters
+    ]
+    if base_layers:
+        model.update_modules(tree_unflatten(base_layers))
+    try:
+        yield model
+    finally:
+        if adapters:
+            model.update_modules(tree_unflatten(adapters))
+
+
+class AdapterDisabledModel:
+    """
+    Reference model that runs the policy model with its adapters disabled.
+
+    It shares the base weights with the policy instead of loading a second
+    copy of the model. Calls are forwarded to the wrapped model inside
+    ``disable_adapters``, and ``freeze`` is a no-op so the policy's adapters
+    stay trainable.
+    """
+
+    def __init__(self, model: nn.Module):
+        self.model = model
+
+    def __call__(self, *args, **kwargs):
+        with disable_adapters(self.model):
+            return self.model(*args, **kwargs)
+
+    def freeze(self, *args, **kwargs):
+        return self
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+
 def fuse_and_save_model(
     model: nn.Module,
     tokenizer: TokenizerWrapper,